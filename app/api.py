@@ -1,3 +1,4 @@
+import json
 import os
 import jwt
 from typing import Any
@@ -5,6 +6,9 @@ from fastapi import APIRouter, Depends, HTTPException, Header, Response
 from app.constants import Privileges
 from app.context import CRequest
 from app.objects.framework import JobStatus, config
+from app.objects.metrics import render_metrics
+from app.objects.principals import Principal, principals
+from app.objects.profiler import profile_key
 
 router = APIRouter()
 
@@ -30,23 +34,38 @@ async def get_current_user(
     user_id = payload.get("sub")
     assert user_id is not None
 
-    data = await request.state.database.fetch_one(
-        "SELECT username, privileges FROM users WHERE id = :user_id LIMIT 1",
-        {"user_id": user_id},
-    )
+    async def fetch_principal() -> Principal | None:
+        data = await request.state.database.fetch_one(
+            "SELECT username, privileges FROM users WHERE id = :user_id LIMIT 1",
+            {"user_id": user_id},
+        )
+
+        if not data:
+            return None
 
-    if not data:
+        return Principal(username=data["username"], privileges=data["privileges"])
+
+    principal = await principals.get(str(user_id), fetch_principal)
+
+    if not principal:
         raise HTTPException(401, {"error": "could not validate jwt token"})
 
-    if not data["privileges"] & Privileges.ADMIN:
+    if not principal.privileges & Privileges.ADMIN:
         raise HTTPException(401, {"error": "not authorized"})
 
     return
 
 
+@router.get("/metrics")
+async def metrics():
+    return Response(
+        render_metrics(config.metrics), media_type="text/plain; version=0.0.4"
+    )
+
+
 @router.get("/")
 async def all_jobs(_=Depends(get_current_user)):
-    return config.jobs
+    return await config.cluster_jobs()
 
 
 @router.get("/job/{job_name}")
@@ -54,7 +73,18 @@ async def get_job(job_name: str, _=Depends(get_current_user)):
     if job_name not in config.jobs:
         return {"error": "job not found"}
 
-    return config.jobs[job_name]
+    return (await config.cluster_jobs())[job_name]
+
+
+@router.get("/job/{job_name}/profile")
+async def get_job_profile(job_name: str, _=Depends(get_current_user)):
+    if job_name not in config.jobs:
+        return {"error": "job not found"}
+
+    if (profile := await config.redis.get(profile_key(job_name))) is None:
+        return {"error": "job hasn't been profiled."}
+
+    return json.loads(profile)
 
 
 @router.post("/start/{job_name}")
@@ -62,10 +92,23 @@ async def start_job(job_name: str, _=Depends(get_current_user)):
     if job_name not in config.jobs:
         return {"error": "job not found"}
 
-    job = config.jobs[job_name]
+    job = (await config.cluster_jobs())[job_name]
 
-    if job.status == JobStatus.IN_PROGRESS:
+    if job.status in (JobStatus.QUEUED, JobStatus.IN_PROGRESS):
         return {"error": "job already in progress."}
 
-    await config.prepare(job_name)
+    if not await config.prepare(job_name):
+        return {"error": "job can't be started manually."}
+
+    return {"status": "ok"}
+
+
+@router.post("/cancel/{job_name}")
+async def cancel_job(job_name: str, _=Depends(get_current_user)):
+    if job_name not in config.jobs:
+        return {"error": "job not found"}
+
+    if not await config.cancel(job_name):
+        return {"error": "job isn't in progress."}
+
     return {"status": "ok"}
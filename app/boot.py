@@ -1,18 +1,17 @@
-import pkgutil
+import asyncio
 from fastapi import FastAPI
 
-from app import jobs
 from app.context import CRequest
 from app.objects.framework import config
+from app.objects.logs import setup_logging
+from app.objects.principals import principals
+from app.objects.registry import import_jobs
 from app.api import router
 
 
 def initialize_jobs() -> None:
-    all_jobs = jobs.__path__
-    job_info = pkgutil.walk_packages(all_jobs, f"{jobs.__name__}.")
-
-    for _, name, _ in job_info:
-        __import__(name)
+    # only the jobs enabled on this node are imported.
+    import_jobs()
 
 
 def inject_database(api: FastAPI) -> None:
@@ -27,6 +26,7 @@ def initialize_framework(api: FastAPI) -> None:
     @api.on_event("startup")
     async def startup() -> None:
         await config.start()
+        asyncio.create_task(principals.listen(config.redis))
 
 
 def initialize_router(api: FastAPI) -> None:
@@ -34,6 +34,7 @@ def initialize_router(api: FastAPI) -> None:
 
 
 def boot_api() -> FastAPI:
+    setup_logging()
     api = FastAPI()
 
     initialize_jobs()
@@ -42,6 +42,15 @@ class Gamemode(IntEnum):
         )
 
 
+# every gamemode and play mode combination that has stats.
+MODE_PAIRS = tuple(
+    (gamemode, play_mode)
+    for gamemode in Gamemode
+    for play_mode in PlayMode
+    if not (gamemode == Gamemode.RELAX and play_mode == PlayMode.MANIA)
+)
+
+
 class Privileges(IntFlag):
     BANNED = 1 << 0
 
@@ -1,9 +1,128 @@
+import asyncio
+import os
+from typing import Sequence
 from databases import Database
 from redis import Redis
+from app.objects.dirty_stats import mark_stats_dirty
 from app.objects.framework import Job, config
+from app.objects.logs import Progress, job_logger
+from app.objects.resources import DB_HEAVY, SCORES_WRITER
+from app.objects.sql import bind_in
 
+CHUNK_SIZE = int(os.getenv("LOVED_MAPS_CHUNK_SIZE", 10_000))
+CHUNK_PAUSE = float(os.getenv("LOVED_MAPS_CHUNK_PAUSE", 0.1))
 
-@config.register("ensure_loved_maps_dont_award_pp", interval=3600)  # every hour
+# md5s of maps that were just loved, queued by whoever loved them.
+LOVED_QUEUE_KEY = "ragnarok:cron:loved_maps"
+FULL_SCAN_KEY = "ragnarok:cron:loved_maps_full_scan"
+FULL_SCAN_INTERVAL = 86400  # every day
+
+log = job_logger("ensure_loved_maps_dont_award_pp")
+
+
+async def fix_loved_scores(
+    database: Database, redis: Redis, map_md5s: Sequence[str] | None = None
+) -> int:
+    """
+    `fix_loved_scores()` sets awards_pp to false for all scores on loved maps
+    in bounded chunks, and returns the amount of affected scores. If `map_md5s`
+    is given only the scores of those maps are fixed, otherwise the whole
+    scores table is walked by primary key range.
+    """
+    fixed = 0
+
+    if map_md5s is not None:
+        md5_placeholders, md5_values = bind_in("map_md5", map_md5s)
+
+        while True:
+            scores = await database.fetch_all(
+                "SELECT s.id, s.user_id, s.gamemode, s.mode FROM scores s "
+                "INNER JOIN beatmaps b ON b.map_md5 = s.map_md5 "
+                f"WHERE s.map_md5 IN ({md5_placeholders}) "
+                "AND b.approved = 5 AND s.awards_pp = 1 LIMIT :limit",
+                md5_values | {"limit": CHUNK_SIZE},
+            )
+
+            if not scores:
+                break
+
+            id_placeholders, id_values = bind_in("id", [s["id"] for s in scores])
+            await database.execute(
+                f"UPDATE scores SET awards_pp = 0 WHERE id IN ({id_placeholders})",
+                id_values,
+            )
+            await mark_stats_dirty(
+                redis, {(s["user_id"], s["gamemode"], s["mode"]) for s in scores}
+            )
+
+            fixed += len(scores)
+            log.info("fixed %d scores on freshly loved maps", len(scores))
+
+            await asyncio.sleep(CHUNK_PAUSE)
+
+        return fixed
+
+    bounds = await database.fetch_one(
+        "SELECT MIN(id) AS low, MAX(id) AS high FROM scores"
+    )
+
+    if not bounds or bounds["low"] is None:
+        return 0
+
+    total = bounds["high"] - bounds["low"] + 1
+    progress = Progress(log, "full scan", total=total)
+
+    for low in range(bounds["low"], bounds["high"] + 1, CHUNK_SIZE):
+        progress.update(low - bounds["low"])
+        values = {"low": low, "high": low + CHUNK_SIZE}
+
+        affected = await database.fetch_all(
+            "SELECT DISTINCT s.user_id, s.gamemode, s.mode FROM scores s "
+            "INNER JOIN beatmaps b ON b.map_md5 = s.map_md5 "
+            "WHERE b.approved = 5 AND s.awards_pp = 1 "
+            "AND s.id >= :low AND s.id < :high",
+            values,
+        )
+
+        if not affected:
+            continue
+
+        # ROW_COUNT() is per connection, so keep both on the same one.
+        async with database.connection() as connection:
+            await connection.execute(
+                "UPDATE scores s INNER JOIN beatmaps b ON b.map_md5 = s.map_md5 "
+                "SET s.awards_pp = 0 WHERE b.approved = 5 AND s.awards_pp = 1 "
+                "AND s.id >= :low AND s.id < :high",
+                values,
+            )
+            updated = await connection.fetch_val("SELECT ROW_COUNT()")
+
+        await mark_stats_dirty(
+            redis, {(a["user_id"], a["gamemode"], a["mode"]) for a in affected}
+        )
+
+        fixed += updated
+        log.info(
+            "fixed %d loved scores with ids %d to %d",
+            updated,
+            low,
+            low + CHUNK_SIZE - 1,
+        )
+
+        # give replication some room to catch up
+        await asyncio.sleep(CHUNK_PAUSE)
+
+    progress.update(total)
+    progress.finish()
+
+    return fixed
+
+
+@config.register(
+    "ensure_loved_maps_dont_award_pp",
+    interval=3600,  # every hour
+    resources=(DB_HEAVY, SCORES_WRITER),
+)
 async def ensure_loved_maps_dont_award_pp(
     job: Job, database: Database, redis: Redis
 ) -> None:
@@ -12,22 +131,33 @@ async def ensure_loved_maps_dont_award_pp(
     has been submitted on a loved beatmap, doesn't have the awards_pp field
     set to true
     """
-    print("Started fixing all pp-awarded loved scores")
-    all_awarded_loved_scores = await database.fetch_all(
-        "SELECT s.id FROM scores s INNER JOIN beatmaps b ON b.map_md5 = s.map_md5 "
-        "WHERE b.approved = 5 AND s.awards_pp = 1"
-    )
+    job.log.info("started fixing all pp-awarded loved scores")
 
-    if not all_awarded_loved_scores:
-        print("No loved scores has awarded pp.")
-        return
+    queued_md5s = await redis.smembers(LOVED_QUEUE_KEY)
 
-    for score in all_awarded_loved_scores:
-        await database.execute(
-            "UPDATE scores SET awards_pp = 0 WHERE id = :id", {"id": score["id"]}
+    if queued_md5s:
+        fixed = await fix_loved_scores(
+            database, redis, [md5.decode() for md5 in queued_md5s]
         )
-        print(
-            f"Updated {score["id"]} to not award pp, as it was submitted on a loved map"
+        await redis.srem(LOVED_QUEUE_KEY, *queued_md5s)
+
+        job.log.info(
+            "fixed %d scores awarding pp on %d loved maps", fixed, len(queued_md5s)
         )
 
-    print(f"Fixed {len(all_awarded_loved_scores)} scores awarding pp on a loved")
+    # the full scan is only a safety net for maps that weren't queued.
+    if not await redis.set(FULL_SCAN_KEY, 1, ex=FULL_SCAN_INTERVAL, nx=True):
+        return
+
+    try:
+        fixed = await fix_loved_scores(database, redis)
+    except BaseException:
+        # a scan that didn't finish is retried on the next run, not tomorrow.
+        await redis.delete(FULL_SCAN_KEY)
+        raise
+
+    if not fixed:
+        job.log.info("no loved scores has awarded pp")
+        return
+
+    job.log.info("fixed %d scores awarding pp on a loved", fixed)
@@ -1,68 +1,478 @@
-from datetime import datetime, timedelta
+import os
+from datetime import date, datetime, timedelta
+from typing import Any
 from databases import Database
 from redis import Redis
-from app.constants import Gamemode, PlayMode
-from app.objects.framework import Job, JobStatus, config
+from app.constants import MODE_PAIRS, Gamemode, PlayMode
+from app.objects.framework import Job, config
+from app.objects.logs import Progress
+from app.objects.resources import DB_HEAVY, USER_STATS
+from app.objects.shards import Shard
+from app.objects.sql import bind_in, chunked
+from app.objects.users import iterate_users
 
+ROWS_PER_BATCH = 1000
+IN_PROGRESS_KEY = "ragnarok:cron:profile_history_in_progress"
+LOGGED_DATE_KEY = "ragnarok:cron:profile_history_logged"
 
-@config.register(name="fill_profile_history", interval=60)  # every minute
-async def fill_profile_history(job: Job, database: Database, redis: Redis) -> None:
-    # ensure stats recalculation isn't already in progress
-    recalc_job = config.jobs["recalculate_user_stats"]
 
-    if recalc_job.status == JobStatus.IN_PROGRESS:
-        return
+# weeks are cut at the start of a month, so every week rolls up into one month.
+PERIOD_STARTS = {
+    "week": lambda day: max(day - timedelta(days=day.weekday()), day.replace(day=1)),
+    "month": lambda day: day.replace(day=1),
+}
 
-    # small hack for it to run on each day shift.
-    current_date = datetime.now().date()
-    latest_date = await database.fetch_val(
-        "SELECT timestamp FROM profile_history ORDER BY timestamp DESC LIMIT 1"
+
+def parse_retention(value: str) -> dict[str, int]:
+    tiers = {}
+
+    for entry in filter(None, (entry.strip() for entry in value.split(","))):
+        period, _, days = entry.partition("=")
+
+        if period.strip() not in PERIOD_STARTS:
+            raise ValueError(f"unknown profile history period {period!r}")
+
+        tiers[period.strip()] = int(days)
+
+    return tiers
+
+
+# daily rows older than this many days are rolled up into a single row per
+# period, which keeps the last pp and rank, and their min and max in the
+# rollups table (see migrations/).
+RETENTION_TIERS = parse_retention(
+    os.getenv("PROFILE_HISTORY_RETENTION", "week=90,month=365")
+)
+COMPACTION_CHUNK_SIZE = int(os.getenv("PROFILE_HISTORY_COMPACTION_CHUNK_SIZE", 5000))
+# the boundary every period was last compacted up to.
+COMPACTED_KEY = "ragnarok:cron:profile_history_compacted"
+
+
+# waits for stats recalculations, so it doesn't log half recalculated stats.
+@config.register(
+    name="fill_profile_history",
+    interval=60,  # every minute
+    shards=8,
+    resources=(DB_HEAVY, USER_STATS),
+)
+async def fill_profile_history(
+    job: Job, database: Database, redis: Redis, shard: Shard
+) -> None:
+    job.log.info(
+        "logging profile history of ids %d to %d",
+        shard.low,
+        shard.high - 1,
+        extra={"sample": False},
     )
 
-    if current_date == latest_date:
-        return
+    if shard.attempts > 1:
+        # a retried shard might've written some of its rows already.
+        await database.execute(
+            "DELETE FROM profile_history WHERE timestamp = :current_date "
+            "AND user_id >= :low AND user_id < :high",
+            {
+                "current_date": datetime.now().date(),
+                "low": shard.low,
+                "high": shard.high,
+            },
+        )
+
+    active_time = (datetime.now() - timedelta(weeks=12)).timestamp()
+    progress = Progress(job.log, f"shard {shard.index}", total=shard.high - shard.low)
+    logged = 0
+
+    # only a batch of users and their stats is held in memory at a time.
+    async for users in iterate_users(
+        database,
+        where="privileges & 4 AND latest_activity_time >= :active_time AND id > 1",
+        values={"active_time": active_time},
+        after=shard.low - 1,
+        before=shard.high,
+        batch_size=ROWS_PER_BATCH,
+        prefetch=True,
+    ):
+        with job.span("users batch", shard=shard.index, users=len(users)):
+            rows = await fetch_history_rows(database, [user["id"] for user in users])
+
+            if rows:
+                await log_history_rows(database, redis, rows)
+
+        shard.processed += len(users)
+        logged += len(rows)
+        progress.update(users[-1]["id"] - shard.low + 1)
 
-    print("Logging all active (played the last 3 months) players history")
-    all_unrestricted_users = await database.fetch_all(
-        "SELECT id, username FROM users WHERE privileges & 4 "
-        "AND latest_activity_time >= :active_time AND id > 1 ",
-        {"active_time": (datetime.now() - timedelta(weeks=12)).timestamp()},
+    progress.finish()
+    job.log.info(
+        "logged %d profile history entries of %d users",
+        logged,
+        shard.processed,
+        extra={"sample": False},
     )
 
-    for user in all_unrestricted_users:
-        print(f"Logging {user["username"]}'s ({user["id"]}) profile history")
 
-        for gamemode in Gamemode:
-            for play_mode in PlayMode:
-                if gamemode == Gamemode.RELAX and play_mode == PlayMode.MANIA:
-                    continue
+async def fetch_history_rows(
+    database: Database, user_ids: list[int]
+) -> list[dict[str, Any]]:
+    rows: list[dict[str, Any]] = []
+    placeholders, values = bind_in("user_id", user_ids)
 
-                current_pp = await database.fetch_val(
-                    f"SELECT CAST({play_mode.to_db("pp")} AS INT) AS pp "
-                    f"FROM {gamemode.table} WHERE id = :user_id",
-                    {"user_id": user["id"]},
-                )
+    for gamemode in Gamemode:
+        play_modes = [mode for gm, mode in MODE_PAIRS if gm == gamemode]
+        columns = ", ".join(
+            f"CAST({play_mode.to_db("pp")} AS INT) AS {play_mode.to_db("pp")}"
+            for play_mode in play_modes
+        )
+
+        all_stats = await database.fetch_all(
+            f"SELECT id, {columns} FROM {gamemode.table} WHERE id IN ({placeholders})",
+            values,
+        )
 
-                if current_pp == 0:
+        for stats in all_stats:
+            for play_mode in play_modes:
+                if not stats[play_mode.to_db("pp")]:
                     # no pp, don't matter
                     continue
 
-                _current_rank = await redis.zrevrank(
-                    f"ragnarok:leaderboard:{gamemode.name.lower()}:{play_mode}",
-                    str(user["id"]),
+                rows.append(
+                    {
+                        "user_id": stats["id"],
+                        "pp": stats[play_mode.to_db("pp")],
+                        "gamemode": gamemode.value,
+                        "mode": play_mode.value,
+                    }
                 )
-                current_rank = _current_rank + 1 if _current_rank is not None else 0
 
-                await database.execute(
-                    "INSERT INTO profile_history (user_id, pp, rank, gamemode, mode) "
-                    "VALUES (:user_id, :pp, :rank, :gamemode, :mode)",
-                    {
-                        "user_id": user["id"],
-                        "pp": current_pp,
-                        "rank": current_rank,
-                        "gamemode": gamemode,
-                        "mode": play_mode,
-                    },
+    return rows
+
+
+async def log_history_rows(
+    database: Database, redis: Redis, rows: list[dict[str, Any]]
+) -> None:
+    for batch in chunked(rows, ROWS_PER_BATCH):
+        async with redis.pipeline(transaction=False) as pipe:
+            for row in batch:
+                pipe.zrevrank(
+                    f"ragnarok:leaderboard:{Gamemode(row["gamemode"]).name.lower()}:{row["mode"]}",
+                    str(row["user_id"]),
                 )
 
-        print(f"successfully logged {user["username"]}'s history for today.")
+            ranks = await pipe.execute()
+
+        values: dict[str, Any] = {}
+        placeholders = []
+
+        for idx, (row, _current_rank) in enumerate(zip(batch, ranks)):
+            current_rank = _current_rank + 1 if _current_rank is not None else 0
+
+            values |= {
+                f"user_id_{idx}": row["user_id"],
+                f"pp_{idx}": row["pp"],
+                f"rank_{idx}": current_rank,
+                f"gamemode_{idx}": row["gamemode"],
+                f"mode_{idx}": row["mode"],
+            }
+            placeholders.append(
+                f"(:user_id_{idx}, :pp_{idx}, :rank_{idx}, :gamemode_{idx}, :mode_{idx})"
+            )
+
+        await database.execute(
+            "INSERT INTO profile_history (user_id, pp, rank, gamemode, mode) "
+            f"VALUES {", ".join(placeholders)}",
+            values,
+        )
+
+
+@config.on_start("fill_profile_history")
+async def prepare_profile_history(
+    job: Job, database: Database, redis: Redis
+) -> bool | None:
+    # small hack for it to run on each day shift.
+    current_date = datetime.now().date()
+    in_progress_date = await redis.get(IN_PROGRESS_KEY)
+    logged_date = await redis.get(LOGGED_DATE_KEY)
+
+    if logged_date is None:
+        # the marker is gone, so look at the table once to restore it.
+        logged_today = await database.fetch_val(
+            "SELECT 1 FROM profile_history WHERE timestamp = :current_date LIMIT 1",
+            {"current_date": current_date},
+        )
+
+        if logged_today:
+            logged_date = str(current_date).encode()
+            await redis.set(LOGGED_DATE_KEY, logged_date)
+
+    if in_progress_date is not None and in_progress_date.decode() == str(current_date):
+        # the last run crashed halfway through today, so throw away
+        # its rows and start over instead of writing duplicates.
+        job.log.info("removing today's partially logged profile history")
+        await database.execute(
+            "DELETE FROM profile_history WHERE timestamp = :current_date",
+            {"current_date": current_date},
+        )
+    elif logged_date is not None and logged_date.decode() == str(current_date):
+        return False
+
+    await redis.set(IN_PROGRESS_KEY, str(current_date))
+
+    job.log.info("logging all active (played the last 3 months) players history")
+
+
+@config.on_finish("fill_profile_history")
+async def finish_profile_history(job: Job, database: Database, redis: Redis) -> None:
+    # the day that's been logged is the one the run started on.
+    await redis.rename(IN_PROGRESS_KEY, LOGGED_DATE_KEY)
+    job.log.info("successfully logged all active players history for today")
+
+
+def compaction_windows(
+    boundaries: list[tuple[str, date]], watermarks: dict[str, date]
+) -> list[tuple[str, date | None, date]]:
+    """
+    `compaction_windows()` returns the (period, start, end) of the rows every
+    tier still has to roll up. A tier rolls up the rows between the boundary
+    of the coarser tier before it and its own boundary, skipping the ones
+    before the boundary it was last compacted up to.
+    """
+    windows = []
+    coarser: date | None = None
+
+    for period, boundary in boundaries:
+        start = coarser
+
+        if (watermark := watermarks.get(period)) is not None:
+            start = max(start, watermark) if start is not None else watermark
+
+        if start is None or start < boundary:
+            windows.append((period, start, boundary))
+
+        coarser = boundary
+
+    return windows
+
+
+def window_condition(column: str, start: date | None) -> str:
+    condition = f"{column} < :end"
+
+    if start is not None:
+        condition = f"{column} >= :start AND {condition}"
+
+    return condition
+
+
+def window_values(start: date | None, end: date) -> dict[str, date]:
+    return {"end": end} | ({"start": start} if start is not None else {})
+
+
+async def compact_history(
+    database: Database,
+    user_ids: list[int],
+    period: str,
+    start: date | None,
+    end: date,
+) -> int:
+    """
+    `compact_history()` rolls the rows of a batch of users within a window up
+    into one row per period, and returns the amount of rolled up periods. The
+    last row of every period is kept, and the rest are deleted afterwards by
+    `delete_compacted()`. Rolling up is idempotent, a period that was rolled
+    up before is only touched again when it grows coarser.
+    """
+    placeholders, values = bind_in("user_id", user_ids)
+    rows = await database.fetch_all(
+        "SELECT h.id, h.user_id, h.gamemode, h.mode, h.pp, h.rank, h.timestamp, "
+        "r.period, r.pp_min, r.pp_max, r.rank_min, r.rank_max "
+        "FROM profile_history h "
+        "LEFT JOIN profile_history_rollups r ON r.history_id = h.id "
+        f"WHERE h.user_id IN ({placeholders}) "
+        f"AND {window_condition("h.timestamp", start)} "
+        "ORDER BY h.timestamp, h.id",
+        values | window_values(start, end),
+    )
+
+    periods: dict[tuple[int, int, int, date], list[Any]] = {}
+
+    for row in rows:
+        key = (
+            row["user_id"],
+            row["gamemode"],
+            row["mode"],
+            PERIOD_STARTS[period](row["timestamp"]),
+        )
+        periods.setdefault(key, []).append(row)
+
+    rollups: list[dict[str, Any]] = []
+
+    for period_rows in periods.values():
+        if len(period_rows) == 1 and period_rows[0]["period"] == period:
+            continue
+
+        # the last row of the period is kept, with the pp and rank it ended on.
+        ranks = [
+            rank
+            for row in period_rows
+            for rank in (
+                (row["rank_min"], row["rank_max"])
+                if row["period"] is not None
+                else (row["rank"],)
+            )
+            if rank
+        ]
+        rollups.append(
+            {
+                "history_id": period_rows[-1]["id"],
+                "period": period,
+                "pp_min": min(
+                    row["pp"] if row["period"] is None else row["pp_min"]
+                    for row in period_rows
+                ),
+                "pp_max": max(
+                    row["pp"] if row["period"] is None else row["pp_max"]
+                    for row in period_rows
+                ),
+                # unranked rows don't count towards the rank range.
+                "rank_min": min(ranks, default=0),
+                "rank_max": max(ranks, default=0),
+            }
+        )
+
+    for chunk in chunked(rollups, COMPACTION_CHUNK_SIZE):
+        id_placeholders, id_values = bind_in(
+            "history_id", [rollup["history_id"] for rollup in chunk]
+        )
+        await database.execute(
+            "DELETE FROM profile_history_rollups "
+            f"WHERE history_id IN ({id_placeholders})",
+            id_values,
+        )
+
+        rollup_values: dict[str, Any] = {}
+        rollup_placeholders = []
+
+        for idx, rollup in enumerate(chunk):
+            rollup_values |= {f"{key}_{idx}": value for key, value in rollup.items()}
+            rollup_placeholders.append(
+                f"(:history_id_{idx}, :period_{idx}, :pp_min_{idx}, :pp_max_{idx}, "
+                f":rank_min_{idx}, :rank_max_{idx})"
+            )
+
+        await database.execute(
+            "INSERT INTO profile_history_rollups "
+            "(history_id, period, pp_min, pp_max, rank_min, rank_max) "
+            f"VALUES {", ".join(rollup_placeholders)}",
+            rollup_values,
+        )
+
+    return len(rollups)
+
+
+async def delete_compacted(
+    database: Database, period: str, start: date | None, end: date
+) -> int:
+    """
+    `delete_compacted()` deletes the rows of a rolled up window that aren't
+    the kept row of their period, along with the rollups of the rows it
+    deleted, and returns the amount of deleted rows. It runs once every
+    period of the window is rolled up, so an interrupted compaction never
+    loses their range.
+    """
+    window = window_values(start, end)
+    bounds = await database.fetch_one(
+        "SELECT MIN(id) AS low, MAX(id) AS high FROM profile_history "
+        f"WHERE {window_condition("timestamp", start)}",
+        window,
+    )
+
+    if bounds is None or bounds["low"] is None:
+        return 0
+
+    deleted = 0
+
+    # deleted by primary key ranges in bounded chunks, so only those are locked.
+    for low in range(bounds["low"], bounds["high"] + 1, COMPACTION_CHUNK_SIZE):
+        ids = {"low": low, "high": low + COMPACTION_CHUNK_SIZE}
+
+        # ROW_COUNT() is per connection, so keep both on the same one.
+        async with database.connection() as connection:
+            await connection.execute(
+                "DELETE FROM profile_history "
+                "WHERE id >= :low AND id < :high "
+                f"AND {window_condition("timestamp", start)} "
+                "AND NOT EXISTS (SELECT 1 FROM profile_history_rollups r "
+                "WHERE r.history_id = profile_history.id AND r.period = :period)",
+                ids | window | {"period": period},
+            )
+            deleted += await connection.fetch_val("SELECT ROW_COUNT()")
+
+        await database.execute(
+            "DELETE FROM profile_history_rollups "
+            "WHERE history_id >= :low AND history_id < :high "
+            "AND NOT EXISTS (SELECT 1 FROM profile_history h "
+            "WHERE h.id = profile_history_rollups.history_id)",
+            ids,
+        )
+
+    return deleted
+
+
+@config.register(
+    name="compact_profile_history",
+    interval=86400,  # every day
+    resources=(DB_HEAVY,),
+    priority=-5,
+)
+async def compact_profile_history(job: Job, database: Database, redis: Redis) -> None:
+    """
+    `compact_profile_history()` rolls daily profile history past its retention
+    up into coarser periods, so the table stops growing with every day.
+    """
+    today = datetime.now().date()
+    # oldest boundary first, so every row is rolled up into the period with
+    # the longest retention it's past. a period is only rolled up once it's over.
+    boundaries = sorted(
+        (
+            (period, PERIOD_STARTS[period](today - timedelta(days=days)))
+            for period, days in RETENTION_TIERS.items()
+        ),
+        key=lambda tier: tier[1],
+    )
+    watermarks = {
+        period.decode(): date.fromisoformat(boundary.decode())
+        for period, boundary in (await redis.hgetall(COMPACTED_KEY)).items()
+    }
+
+    # the boundaries only move once a week or month, so most runs have nothing to do.
+    if not (windows := compaction_windows(boundaries, watermarks)):
+        return
+
+    for period, start, end in windows:
+        job.log.info(
+            "compacting profile history into %s rows from %s until %s",
+            period,
+            start or "the start",
+            end,
+        )
+
+    progress = Progress(job.log, "profile history compaction")
+    rolled_up = deleted = 0
+
+    async for users in iterate_users(
+        database, batch_size=ROWS_PER_BATCH, prefetch=True
+    ):
+        user_ids = [user["id"] for user in users]
+
+        for period, start, end in windows:
+            rolled_up += await compact_history(database, user_ids, period, start, end)
+
+        progress.advance(len(users))
+
+    progress.finish()
+
+    for period, start, end in windows:
+        deleted += await delete_compacted(database, period, start, end)
+        await redis.hset(COMPACTED_KEY, period, str(end))
+
+    job.log.info(
+        "rolled up %d profile history periods, deleting %d rows", rolled_up, deleted
+    )
@@ -1,79 +1,294 @@
+from typing import Any, Iterable, Mapping, Sequence
 from databases import Database
 from redis import Redis
-from app.constants import Gamemode, PlayMode
+from app.constants import MODE_PAIRS, Gamemode, PlayMode
+from app.objects.dirty_stats import (
+    DIRTY_STATS_KEY,
+    DIRTY_STATS_PROCESSING_KEY,
+    mark_stats_dirty,
+)
 from app.objects.framework import Job, config
+from app.objects.leaderboard import (
+    LeaderboardRebuild,
+    leaderboard_keys,
+    remove_from_leaderboards,
+    write_leaderboards,
+)
+from app.objects.logs import Progress
+from app.objects.resources import DB_HEAVY, USER_STATS
+from app.objects.shards import Shard
+from app.objects.sql import bind_in, chunked
+from app.objects.stats import (
+    SCORE_WATERMARK_KEY,
+    UserStats,
+    fetch_top_scores,
+    update_user_stats,
+    weigh_top_scores,
+)
+from app.objects.users import iterate_users
 
+USERS_PER_CHUNK = 500
+REBUILD_WATERMARK_KEY = "ragnarok:cron:stats_rebuild_watermark"
 
-@config.register(name="recalculate_user_stats", is_controllable=True)
-async def recalculate_user_stats(job: Job, database: Database, redis: Redis) -> None:
+
+async def recalculate_users(
+    database: Database,
+    redis: Redis,
+    users: Sequence[Mapping[str, Any]],
+    only: set[tuple[int, int, int]] | None = None,
+    rebuild: LeaderboardRebuild | None = None,
+) -> None:
+    """
+    `recalculate_users()` recalculates the pp and accuracy of a batch of users,
+    optionally limited to the given (user_id, gamemode, mode) pairs. If a
+    leaderboard rebuild is given, the leaderboards are written to it instead
+    of the live ones. Given pairs without any pp awarding scores left are
+    zeroed and taken off the leaderboards.
+    """
+    countries = {user["id"]: user["country"] for user in users}
+
+    scores = await fetch_top_scores(
+        database,
+        list(countries),
+        {(gamemode, mode) for _, gamemode, mode in only} if only is not None else None,
+    )
+    stats = weigh_top_scores(scores)
+    emptied: list[tuple[int, int, int]] = []
+
+    if only is not None:
+        stats = [
+            entry
+            for entry in stats
+            if (entry.user_id, entry.gamemode.value, entry.play_mode.value) in only
+        ]
+        weighed = {
+            (entry.user_id, entry.gamemode.value, entry.play_mode.value)
+            for entry in stats
+        }
+        # e.g. all of their scores were on maps that got loved since.
+        emptied = [
+            (user_id, gamemode, mode)
+            for user_id, gamemode, mode in sorted(only)
+            if user_id in countries
+            and (user_id, gamemode, mode) not in weighed
+            and (Gamemode(gamemode), PlayMode(mode)) in MODE_PAIRS
+        ]
+
+    if stats or emptied:
+        await update_user_stats(
+            database,
+            stats
+            + [
+                UserStats(
+                    user_id=user_id,
+                    gamemode=Gamemode(gamemode),
+                    play_mode=PlayMode(mode),
+                    pp=0,
+                    accuracy=0,
+                )
+                for user_id, gamemode, mode in emptied
+            ],
+        )
+
+    # repopulate redis leaderboards
+    leaderboards: dict[str, dict[str, float]] = {}
+
+    for entry in stats:
+        for key in leaderboard_keys(
+            entry.gamemode.name.lower(),
+            entry.play_mode.value,
+            countries[entry.user_id],
+        ):
+            if rebuild is not None:
+                await rebuild.add(key, str(entry.user_id), entry.pp)
+            else:
+                leaderboards.setdefault(key, {})[str(entry.user_id)] = entry.pp
+
+    await write_leaderboards(redis, leaderboards)
+    await remove_users_from_leaderboards(redis, emptied, countries)
+
+
+async def remove_users_from_leaderboards(
+    redis: Redis,
+    pairs: Iterable[tuple[int, int, int]],
+    countries: Mapping[int, str],
+) -> None:
+    """
+    `remove_users_from_leaderboards()` removes the (user_id, gamemode, mode)
+    pairs from their global and country leaderboards.
+    """
+    removals: dict[str, list[str]] = {}
+
+    for user_id, gamemode, mode in pairs:
+        for key in leaderboard_keys(
+            Gamemode(gamemode).name.lower(), mode, countries[user_id]
+        ):
+            removals.setdefault(key, []).append(str(user_id))
+
+    await remove_from_leaderboards(redis, removals)
+
+
+@config.register(
+    name="recalculate_user_stats",
+    is_controllable=True,
+    shards=8,
+    resources=(DB_HEAVY, USER_STATS),
+    priority=10,
+)
+async def recalculate_user_stats(
+    job: Job, database: Database, redis: Redis, shard: Shard
+) -> None:
     """
     `recalculate_user_stats()` recalculates all users pp and accuracy
     for all play- and gamemodes.
     """
-    print("Starting to recalculate all user stats")
-    all_users = await database.fetch_all("SELECT * FROM users WHERE privileges & 4")
-
-    for user in all_users:
-        print(f"Recalculating {user["username"]}'s total weighted pp")
-
-        for gamemode in Gamemode:
-            for play_mode in PlayMode:
-                if gamemode == Gamemode.RELAX and play_mode == PlayMode.MANIA:
-                    continue
-
-                important_scores = await database.fetch_all(
-                    query="SELECT pp, accuracy FROM scores "
-                    "WHERE user_id = :user_id AND mode = :mode "
-                    "AND status = 3 AND gamemode = :gamemode "
-                    "AND awards_pp = 1 ORDER BY pp DESC LIMIT 100",
-                    values={
-                        "user_id": user["id"],
-                        "mode": play_mode.value,
-                        "gamemode": gamemode.value,
-                    },
-                )
+    job.log.info(
+        "recalculating user stats of ids %d to %d",
+        shard.low,
+        shard.high - 1,
+        extra={"sample": False},
+    )
 
-                if not important_scores:
-                    print(
-                        f"{user["username"]} hasn't submitted any scores on {gamemode.name.lower()} for {play_mode.name.lower()}.. ignore"
-                    )
-                    continue
-
-                overall_accuracy = 0
-                weighted_pp = 0
-
-                for place, score in enumerate(important_scores):
-                    overall_accuracy += score["accuracy"] * 0.95**place
-                    weighted_pp += score["pp"] * 0.95**place
-
-                # bonus accuracy
-                overall_accuracy *= 100 / (20 * (1 - 0.95 ** len(important_scores)))
-                overall_accuracy /= 100
-
-                # bonus pp
-                weighted_pp += 416.6667 * (1 - 0.9994 ** len(important_scores))
-
-                await database.execute(
-                    query=f"UPDATE {gamemode.table} SET {play_mode.to_db("pp")} = :new_pp, "
-                    f"{play_mode.to_db("accuracy")} = :new_accuracy WHERE id = :user_id",
-                    values={
-                        "new_pp": weighted_pp,
-                        "new_accuracy": overall_accuracy,
-                        "user_id": user["id"],
-                    },
-                )
+    # leaderboards are rebuilt on the side and swapped in once finished,
+    # so readers never see a half-rebuilt leaderboard.
+    rebuild = LeaderboardRebuild(redis)
+    cursor = await job.checkpoint.get(f"shard:{shard.index}")
+    progress = Progress(job.log, f"shard {shard.index}", total=shard.high - shard.low)
 
-                # repopulate redis leaderboards
-                await redis.zadd(
-                    f"ragnarok:leaderboard:{gamemode.name.lower()}:{play_mode.value}",
-                    {str(user["id"]): weighted_pp},
-                )
+    async for users in iterate_users(
+        database,
+        columns=("id", "country"),
+        where="privileges & 4",
+        after=int(cursor) if cursor is not None else shard.low - 1,
+        before=shard.high,
+        batch_size=USERS_PER_CHUNK,
+        prefetch=True,
+    ):
+        last_id = users[-1]["id"]
 
-                await redis.zadd(
-                    f"ragnarok:leaderboard:{gamemode.name.lower()}:{user["country"]}:{play_mode.value}",
-                    {str(user["id"]): weighted_pp},
-                )
+        with job.span("users batch", shard=shard.index, users=len(users)):
+            await recalculate_users(database, redis, users, rebuild=rebuild)
+
+            # everything up to here is in the staged leaderboards,
+            # so an interrupted run can continue after it.
+            await rebuild.flush()
+            await job.checkpoint.set(
+                last_id, f"shard:{shard.index}", token=shard.fencing_token
+            )
+
+        shard.processed += len(users)
+        # progressed through the shard's id range, rather than its users.
+        progress.update(last_id - shard.low + 1)
+
+    progress.finish()
+
+
+@config.on_start("recalculate_user_stats")
+async def prepare_user_stats_recalculation(
+    job: Job, database: Database, redis: Redis
+) -> None:
+    if job.resumed:
+        # keep the staged leaderboards and watermark of the interrupted run.
+        job.log.info("resuming the interrupted recalculation of all user stats")
+        return
+
+    job.log.info("starting to recalculate all user stats")
+
+    # everything submitted up until now is covered by this run,
+    # so the incremental recalculation can continue from here.
+    latest_score_id = await database.fetch_val("SELECT MAX(id) FROM scores") or 0
+    await redis.set(REBUILD_WATERMARK_KEY, latest_score_id)
+    await redis.delete(DIRTY_STATS_KEY, DIRTY_STATS_PROCESSING_KEY)
+
+    await LeaderboardRebuild(redis).begin()
+
+
+@config.on_finish("recalculate_user_stats")
+async def finish_user_stats_recalculation(
+    job: Job, database: Database, redis: Redis
+) -> None:
+    await LeaderboardRebuild(redis).commit(job.name, job.fencing_token)
+    await redis.rename(REBUILD_WATERMARK_KEY, SCORE_WATERMARK_KEY)
+
+    job.log.info("finished recalculating all users weighted pp and overall accuracy")
+
+
+# waits for a full recalculation, which covers everything it would.
+@config.register(
+    name="recalculate_dirty_user_stats",
+    interval=60,  # every minute
+    resources=(USER_STATS,),
+    priority=5,
+)
+async def recalculate_dirty_user_stats(
+    job: Job, database: Database, redis: Redis
+) -> None:
+    """
+    `recalculate_dirty_user_stats()` recalculates pp and accuracy only for
+    the users and modes that had scores changed since the last run.
+    """
+    latest_score_id = await database.fetch_val("SELECT MAX(id) FROM scores") or 0
+    watermark = await redis.get(SCORE_WATERMARK_KEY)
+
+    if watermark is None:
+        # no baseline yet, everything before this point
+        # is only covered by a full recalculation.
+        await redis.set(SCORE_WATERMARK_KEY, latest_score_id)
+        return
+
+    changed = await database.fetch_all(
+        "SELECT DISTINCT user_id, gamemode, mode FROM scores "
+        "WHERE id > :watermark AND id <= :latest_score_id",
+        {"watermark": int(watermark), "latest_score_id": latest_score_id},
+    )
+    await mark_stats_dirty(
+        redis, ((row["user_id"], row["gamemode"], row["mode"]) for row in changed)
+    )
+    await redis.set(SCORE_WATERMARK_KEY, latest_score_id)
+
+    # taken all at once, so stats marked dirty during the run are left for
+    # the next one. whatever a failed run left behind is taken along again.
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.sunionstore(
+            DIRTY_STATS_PROCESSING_KEY, [DIRTY_STATS_PROCESSING_KEY, DIRTY_STATS_KEY]
+        )
+        pipe.delete(DIRTY_STATS_KEY)
+        pipe.smembers(DIRTY_STATS_PROCESSING_KEY)
+        *_, dirty_members = await pipe.execute()
+
+    if not dirty_members:
+        return
+
+    dirty: set[tuple[int, int, int]] = set()
+
+    for member in dirty_members:
+        user_id, gamemode, mode = member.decode().split(":")
+        dirty.add((int(user_id), int(gamemode), int(mode)))
+
+    user_ids = sorted({user_id for user_id, _, _ in dirty})
+
+    for user_chunk in chunked(user_ids, USERS_PER_CHUNK):
+        placeholders, values = bind_in("user_id", user_chunk)
+        users = await database.fetch_all(
+            f"SELECT id, country, privileges FROM users WHERE id IN ({placeholders})",
+            values,
+        )
+        ranked = [user for user in users if user["privileges"] & 4]
+        restricted = {
+            user["id"]: user["country"] for user in users if not user["privileges"] & 4
+        }
+
+        if ranked:
+            await recalculate_users(database, redis, ranked, only=dirty)
 
-                print(f"Finished recalculating {user["username"]}'s pp and accuracy.")
+        # restricted users don't belong on the leaderboards anymore.
+        await remove_users_from_leaderboards(
+            redis,
+            (pair for pair in dirty if pair[0] in restricted),
+            restricted,
+        )
 
-    print("Finished recalculating all users weighted pp and overall accuracy.")
+    await redis.delete(DIRTY_STATS_PROCESSING_KEY)
+    job.log.info(
+        "recalculated %d dirty user stats across %d users", len(dirty), len(user_ids)
+    )
@@ -0,0 +1,172 @@
+from typing import AsyncIterator, Sequence
+from databases import Database
+from redis import Redis
+from app.constants import MODE_PAIRS, Gamemode, PlayMode
+from app.objects.framework import Job, config
+from app.objects.leaderboard import LEADERBOARD_PREFIX, leaderboard_keys
+from app.objects.resources import USER_STATS
+from app.objects.sql import bind_in
+
+MEMBERS_PER_BATCH = 1000
+# the pp columns are single precision, so they're a bit off what was written.
+PP_TOLERANCE = 0.01
+
+
+async def scan_leaderboard(
+    redis: Redis, key: str
+) -> AsyncIterator[Sequence[tuple[bytes, float]]]:
+    """
+    `scan_leaderboard()` yields the members of a leaderboard with their
+    scores in batches, without blocking redis like a full ZRANGE would.
+    """
+    cursor = 0
+
+    while True:
+        cursor, entries = await redis.zscan(key, cursor, count=MEMBERS_PER_BATCH)
+
+        if entries:
+            yield entries
+
+        if cursor == 0:
+            return
+
+
+async def fetch_ranked_users(
+    database: Database, gamemode: Gamemode, play_mode: PlayMode, user_ids: list[int]
+) -> dict[int, tuple[str, float]]:
+    """
+    `fetch_ranked_users()` returns the country and pp of every given user
+    that belongs on the leaderboards of a gamemode and play mode.
+    """
+    placeholders, values = bind_in("user_id", user_ids)
+    rows = await database.fetch_all(
+        f"SELECT u.id, u.country, s.{play_mode.to_db("pp")} AS pp "
+        f"FROM users u INNER JOIN {gamemode.table} s ON s.id = u.id "
+        f"WHERE u.privileges & 4 AND u.id IN ({placeholders})",
+        values,
+    )
+
+    # recalculated stats always have bonus pp, so no pp means no scores.
+    return {
+        row["id"]: (row["country"], float(row["pp"])) for row in rows if row["pp"] > 0
+    }
+
+
+async def reconcile_leaderboard(
+    database: Database,
+    redis: Redis,
+    gamemode: Gamemode,
+    play_mode: PlayMode,
+    key: str,
+    country: str | None = None,
+) -> tuple[int, int]:
+    """
+    `reconcile_leaderboard()` removes the members of a leaderboard that
+    don't belong on it anymore, and corrects the pp of those that do. For
+    a global leaderboard, its members are also added to the leaderboard
+    of their current country. Returns the amount of updated and removed
+    members.
+    """
+    updated = removed = 0
+
+    async for entries in scan_leaderboard(redis, key):
+        user_ids = [int(member) for member, _ in entries if member.isdigit()]
+        ranked = (
+            await fetch_ranked_users(database, gamemode, play_mode, user_ids)
+            if user_ids
+            else {}
+        )
+
+        stale: list[bytes] = []
+        updates: dict[str, dict[str, float]] = {}
+
+        for member, score in entries:
+            user = ranked.get(int(member)) if member.isdigit() else None
+
+            if user is None or (country is not None and user[0] != country):
+                stale.append(member)
+            elif abs(user[1] - score) > PP_TOLERANCE:
+                updates.setdefault(key, {})[member.decode()] = user[1]
+
+        if country is None and ranked:
+            # users that changed countries are missing from their new one.
+            country_keys = {
+                user_id: leaderboard_keys(
+                    gamemode.name.lower(), play_mode.value, user_country
+                )[1]
+                for user_id, (user_country, _) in ranked.items()
+            }
+
+            async with redis.pipeline(transaction=False) as pipe:
+                for user_id, country_key in country_keys.items():
+                    pipe.zscore(country_key, user_id)
+
+                country_scores = await pipe.execute()
+
+            for (user_id, country_key), score in zip(
+                country_keys.items(), country_scores
+            ):
+                pp = ranked[user_id][1]
+
+                if score is None or abs(pp - score) > PP_TOLERANCE:
+                    updates.setdefault(country_key, {})[str(user_id)] = pp
+
+        if not stale and not updates:
+            continue
+
+        async with redis.pipeline(transaction=False) as pipe:
+            if stale:
+                pipe.zrem(key, *stale)
+
+            for update_key, mapping in updates.items():
+                pipe.zadd(update_key, mapping)
+
+            await pipe.execute()
+
+        updated += sum(len(mapping) for mapping in updates.values())
+        removed += len(stale)
+
+    return updated, removed
+
+
+# waits for stats recalculations, which write the leaderboards themselves.
+@config.register(
+    name="reconcile_leaderboards",
+    interval=3600,  # every hour
+    resources=(USER_STATS,),
+)
+async def reconcile_leaderboards(job: Job, database: Database, redis: Redis) -> None:
+    """
+    `reconcile_leaderboards()` corrects the leaderboards that drifted from
+    the stats tables, such as restricted users that are still ranked or
+    users that are still ranked in their previous country. Only the
+    differences are written, so it's a lot cheaper than a full recalculation.
+    """
+    job.log.info("starting to reconcile leaderboards")
+    updated = removed = 0
+
+    for gamemode, play_mode in MODE_PAIRS:
+        keys: list[tuple[str, str | None]] = [
+            (f"{LEADERBOARD_PREFIX}:{gamemode.name.lower()}:{play_mode.value}", None)
+        ]
+
+        # reconciling the global leaderboard first adds members to their
+        # new country's leaderboard, before the previous one is reconciled.
+        async for key in redis.scan_iter(
+            f"{LEADERBOARD_PREFIX}:{gamemode.name.lower()}:*:{play_mode.value}"
+        ):
+            key = key.decode()
+            keys.append((key, key.rsplit(":", 2)[1]))
+
+        for key, country in keys:
+            key_updated, key_removed = await reconcile_leaderboard(
+                database, redis, gamemode, play_mode, key, country
+            )
+            updated += key_updated
+            removed += key_removed
+
+    job.log.info(
+        "finished reconciling leaderboards, updated %d and removed %d members",
+        updated,
+        removed,
+    )
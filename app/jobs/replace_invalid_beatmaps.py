@@ -1,141 +1,307 @@
 import asyncio
-from datetime import datetime, timedelta
+import hashlib
+import logging
+import mmap
+import multiprocessing
 import os
-import aiohttp
-from dataclasses import dataclass
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 from databases import Database
 from redis import Redis
 from app.objects.framework import Job, config
-
-BEATMAPS_DIRECTORY = Path(os.environ["BEATMAPS_DIRECTORY"])
-HTTP_459_RESPONSE = """
-<html>                                                                                                                                     
-<head><title>429 Too Many Requests</title></head>                                                                                          
-<body>                                                                                                                                     
-<center><h1>429 Too Many Requests</h1></center>                                                                                            
-<hr><center>nginx</center>                                                                                                                 
-</body>                                                                                                                                    
-</html> 
-"""
-
-
-@dataclass
-class DotOsuEndpoint:
-    host: str
-    endpoint: str
-    ratelimit_pause: datetime | None = None
-    corrected_files: int = 0
-
+from app.objects.logs import Progress
+from app.objects.manifest import ScanManifest, Verdict
+from app.objects.mirrors import DotOsuEndpoint, MirrorFetcher
+from app.objects.resources import DISK_SCAN
+from app.objects.sql import bind_in, chunked
 
 BANCHO_OSU_ENDPOINT = DotOsuEndpoint(
     host="bancho",
     endpoint="https://osu.ppy.sh/web/osu-getosufile.php?q={map_id}",
+    rate=1,
 )
 MINO_OSU_ENDPOINT = DotOsuEndpoint(
     host="mino",
     endpoint="https://catboy.best/osu/{map_id}?raw=1",
+    rate=2,
+    capacity=10,
 )
+FETCH_WORKERS = 8
+
+CHECK_WORKERS = 16
+CHECK_BATCH_SIZE = 1000
+# the nginx error page has its title well within the first few hundred bytes.
+CHECK_PREFIX_SIZE = 512
+
+HASH_WORKERS = int(os.getenv("BEATMAP_HASH_WORKERS") or os.cpu_count() or 1)
+HASH_BATCH_SIZE = 1000
+HASH_FILES_PER_TASK = 50
+
+
+def beatmaps_directory() -> Path:
+    # read on the first run, so importing the jobs doesn't require it.
+    return Path(os.environ["BEATMAPS_DIRECTORY"])
+
+
+def beatmaps_manifest() -> Path:
+    return Path(
+        os.getenv("BEATMAPS_MANIFEST")
+        or beatmaps_directory().parent / ".beatmaps.manifest"
+    )
+
+
+def check_dot_osu(path: Path) -> Verdict:
+    with path.open("rb") as osu:
+        prefix = osu.read(CHECK_PREFIX_SIZE)
+
+    if b"429 Too Many Requests" in prefix:
+        return Verdict.CORRUPTED
+
+    return Verdict.VALID
+
+
+def hash_dot_osus(paths: list[Path]) -> list[tuple[str, int] | None]:
+    """
+    `hash_dot_osus()` returns the md5 and size of every file, or None for
+    files that were removed since the scan. It runs in a worker process
+    and maps the files instead of copying them.
+    """
+    hashes: list[tuple[str, int] | None] = []
+
+    for path in paths:
+        try:
+            osu = path.open("rb")
+        except FileNotFoundError:
+            hashes.append(None)
+            continue
+
+        with osu:
+            size = os.fstat(osu.fileno()).st_size
+
+            # empty files can't be mapped
+            if size == 0:
+                hashes.append((hashlib.md5().hexdigest(), 0))
+                continue
+
+            with mmap.mmap(osu.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                hashes.append((hashlib.md5(mapped).hexdigest(), size))
+
+    return hashes
+
+
+async def repair_beatmaps(
+    map_ids: list[str], manifest: ScanManifest, log: logging.Logger
+) -> None:
+    """
+    `repair_beatmaps()` fetches the given beatmaps from the mirrors, and
+    overwrites the local .osu files with them.
+    """
+    directory = beatmaps_directory()
+    progress = Progress(log, "repairing .osu files", total=len(map_ids))
+
+    async def replace(map_id: str, host: DotOsuEndpoint, decoded: str) -> None:
+        dot_osu = directory / f"{map_id}.osu"
+        await asyncio.to_thread(dot_osu.write_text, decoded)
+
+        stat = dot_osu.stat()
+        manifest.update(dot_osu.name, stat.st_size, stat.st_mtime_ns, Verdict.VALID)
+        log.info("%s: corrected %s", host.host, dot_osu.name)
+        progress.advance()
 
+    # prioritise osu.ppy.sh for beatmap, but if it fails, use mino.
+    async with MirrorFetcher(
+        (BANCHO_OSU_ENDPOINT, MINO_OSU_ENDPOINT), workers=FETCH_WORKERS
+    ) as fetcher:
+        await fetcher.run(map_ids, replace)
 
-@config.register(name="replace_invalid_beatmaps", interval=86400)  # every day
+    progress.finish()
+    await asyncio.to_thread(manifest.save)
+
+
+@config.register(
+    name="replace_invalid_beatmaps",
+    interval=86400,  # every day
+    resources=(DISK_SCAN,),
+    priority=-5,
+)
 async def replace_invalid_beatmaps(job: Job, database: Database, redis: Redis) -> None:
     """
     `replace_invalid_beatmaps()` replaces all .osu files in the server directory that
     has been wrongfully saved.
     """
 
-    client_session = aiohttp.ClientSession()
-    mirror_order = (BANCHO_OSU_ENDPOINT, MINO_OSU_ENDPOINT)
-    corrupted = 0
+    job.log.info("started looking through all saved .osu files")
 
-    print("Started looking through all saved .osu files.")
+    directory = beatmaps_directory()
+    manifest = ScanManifest(beatmaps_manifest())
+    await asyncio.to_thread(manifest.load)
 
-    for dot_osu in BEATMAPS_DIRECTORY.iterdir():
-        map_id = dot_osu.name[:-4]
+    # only new or modified files have to be read, the rest keep their verdict.
+    changed = await asyncio.to_thread(manifest.scan, directory, ".osu")
+    job.log.info("checking %d new or modified .osu files", len(changed))
 
-        with dot_osu.open("r+") as osu:
-            delimitation = osu.read(len(HTTP_459_RESPONSE))
+    progress = Progress(job.log, "checking .osu files", total=len(changed))
+    loop = asyncio.get_running_loop()
 
-            if "429 Too Many Requests" not in delimitation:
-                continue
+    with ThreadPoolExecutor(CHECK_WORKERS) as pool:
+        for batch in chunked(changed, CHECK_BATCH_SIZE):
+            verdicts = await asyncio.gather(
+                *(
+                    loop.run_in_executor(pool, check_dot_osu, directory / name)
+                    for name, _, _ in batch
+                )
+            )
 
-            corrupted += 1
+            for (name, size, mtime_ns), verdict in zip(batch, verdicts):
+                manifest.update(name, size, mtime_ns, verdict)
+
+            # an interrupted run only has to check the files after the last save.
+            if manifest.save_due():
+                await asyncio.to_thread(manifest.save)
+
+            progress.advance(len(batch))
+
+    progress.finish()
+    await asyncio.to_thread(manifest.save)
+
+    corrupted = [name[:-4] for name in manifest.with_verdict(Verdict.CORRUPTED)]
+    job.log.info(
+        "found %d corrupted .osu files, fetching them from mirrors", len(corrupted)
+    )
+
+    await repair_beatmaps(corrupted, manifest, job.log)
+
+    job.log.info(
+        "finished looking through all saved .osu files and fixed %d files, "
+        "where mino corrected %d files and bancho corrected %d files",
+        MINO_OSU_ENDPOINT.corrected_files + BANCHO_OSU_ENDPOINT.corrected_files,
+        MINO_OSU_ENDPOINT.corrected_files,
+        BANCHO_OSU_ENDPOINT.corrected_files,
+    )
+
+    return
 
-            # prioritise osu.ppy.sh for beatmap, but if it fails, use mino.
-            for host in mirror_order:
-                if host.ratelimit_pause and host.ratelimit_pause > datetime.now():
-                    continue
 
-                if host.ratelimit_pause and host.ratelimit_pause < datetime.now():
-                    print(f"{host.host}: ratelimited reset")
-                    host.ratelimit_pause = None
+@config.register(
+    name="verify_beatmaps",
+    is_controllable=True,
+    resources=(DISK_SCAN,),
+    priority=-5,
+)
+async def verify_beatmaps(job: Job, database: Database, redis: Redis) -> None:
+    """
+    `verify_beatmaps()` hashes every saved .osu file and compares it to the
+    md5 of the beatmap in the database. Files that don't match, such as
+    truncated downloads or error pages, are fetched from the mirrors again.
+    """
+    job.log.info("started verifying all saved .osu files")
+
+    directory = beatmaps_directory()
+    manifest = ScanManifest(beatmaps_manifest())
+    await asyncio.to_thread(manifest.load)
+    changed = await asyncio.to_thread(manifest.scan, directory, ".osu")
 
-                response = await client_session.get(host.endpoint.format(map_id=map_id))
+    names = sorted(manifest.entries.keys() | {name for name, _, _ in changed})
 
-                # if the response is 459, it should start ratelimit pause and use the next endpoint
-                if response.status == 459:
-                    host.ratelimit_pause = datetime.now() + timedelta(minutes=1, seconds=30)
-                    print(
-                        f"{host.host}: reached ratelimit and will continue to the other mirror."
+    # an interrupted run continues after the last file it got to.
+    if (cursor := await job.checkpoint.get()) is not None:
+        names = [name for name in names if name > cursor]
+        job.log.info("resuming after %s, %d files left", cursor, len(names))
+
+    mismatched: list[str] = []
+    hashed_files = 0
+    hashed_bytes = 0
+    started_at = time.perf_counter()
+
+    progress = Progress(job.log, "hashing .osu files", total=len(names))
+    loop = asyncio.get_running_loop()
+
+    # forking a process that runs an event loop and worker threads can
+    # deadlock the children on locks held at the time, so they're started
+    # from a clean server process instead.
+    with ProcessPoolExecutor(
+        HASH_WORKERS, mp_context=multiprocessing.get_context("forkserver")
+    ) as pool:
+        for batch in chunked(names, HASH_BATCH_SIZE):
+            results = await asyncio.gather(
+                *(
+                    loop.run_in_executor(
+                        pool,
+                        hash_dot_osus,
+                        [directory / name for name in task],
                     )
+                    for task in chunked(batch, HASH_FILES_PER_TASK)
+                )
+            )
+            hashes: dict[str, tuple[str, int]] = {}
+
+            for name, md5_and_size in zip(
+                batch, (result for task in results for result in task)
+            ):
+                if md5_and_size is None:
+                    # removed since the scan, nothing left to verify.
+                    manifest.forget(name)
                     continue
 
-                # even if the map doesn't exist on bancho, it'll still return 200
-                # therefore we need to check if the response text is empty.
-                if host.host == "bancho" and response.status == 200:
-                    decoded = await response.text()
-                    if decoded == "":
-                        print(
-                            f"{host.host}: beatmap {map_id} doesn't exist on the official server, checking mirror."
-                        )
-                        continue
+                hashes[name[:-4]] = md5_and_size
 
-                if host.host == "mino":
-                    # mino does handle it correctly and returns 404 if the beatmap doesn't exist.
-                    # but we'll also want to check for other statuses.
-                    if response.status != 200:
-                        decoded = await response.json()
-                        print(
-                            f"{host.host}: beatmap {map_id} returned error: {decoded["error"]}"
-                        )
-                        continue
+            beatmaps = []
 
-                    # use x-ratelimit-remaining to start ratelimit before 459 and save
-                    # our ip from getting automatically banned.
-                    ratelimit_remaining = response.headers["x-ratelimit-remaining"]
+            if hashes:
+                placeholders, values = bind_in("map_id", list(hashes))
+                beatmaps = await database.fetch_all(
+                    "SELECT map_id, map_md5 FROM beatmaps "
+                    f"WHERE map_id IN ({placeholders})",
+                    values,
+                )
 
-                    if ratelimit_remaining == 1:
-                        host.ratelimit_pause = datetime.now() + timedelta(minutes=1, seconds=30)
+            for beatmap in beatmaps:
+                map_id = str(beatmap["map_id"])
+                map_md5, _ = hashes[map_id]
+
+                if map_md5 != beatmap["map_md5"]:
+                    try:
+                        stat = (directory / f"{map_id}.osu").stat()
+                    except FileNotFoundError:
+                        manifest.forget(f"{map_id}.osu")
                         continue
 
-                if "nginx" in decoded:
-                    print(f"{host.host}: unhandled response: (code {response.status})")
-                    print(decoded)
-                    continue
+                    mismatched.append(map_id)
+                    manifest.update(
+                        f"{map_id}.osu",
+                        stat.st_size,
+                        stat.st_mtime_ns,
+                        Verdict.CORRUPTED,
+                    )
 
-                # go back to the start
-                osu.seek(0)
-                # truncate all data
-                osu.truncate()
-                # write the new uncorrupted
-                osu.write(decoded)
-                # close file
-                osu.close()
+            hashed_files += len(hashes)
+            hashed_bytes += sum(size for _, size in hashes.values())
 
-                host.corrected_files += 1
-                print(f"{host.host}: corrected {dot_osu.name}.")
+            # the cursor only moves past files whose verdicts are saved.
+            if manifest.save_due():
+                await asyncio.to_thread(manifest.save)
+                await job.checkpoint.set(batch[-1])
 
-                await asyncio.sleep(0.5)
-                break
+            progress.advance(len(batch))
 
-    await client_session.close()
+    await asyncio.to_thread(manifest.save)
 
-    print(
-        "Finished looking through all saved .osu files",
-        f"and fixed {MINO_OSU_ENDPOINT.corrected_files + BANCHO_OSU_ENDPOINT.corrected_files} files,",
-        f"where Mino corrected {MINO_OSU_ENDPOINT.corrected_files} files and bancho corrected",
-        f"{BANCHO_OSU_ENDPOINT.corrected_files} files",
+    elapsed = max(time.perf_counter() - started_at, 1e-9)
+    job.log.info(
+        "hashed %d files (%.1f MB) in %.1fs with %d workers, "
+        "%.0f files/s and %.1f MB/s",
+        hashed_files,
+        hashed_bytes / 1_000_000,
+        elapsed,
+        HASH_WORKERS,
+        hashed_files / elapsed,
+        hashed_bytes / 1_000_000 / elapsed,
+    )
+    job.log.info(
+        "found %d .osu files not matching their md5, repairing them", len(mismatched)
     )
 
-    return
+    # mismatches found before an interruption are only in the manifest.
+    corrupted = [name[:-4] for name in manifest.with_verdict(Verdict.CORRUPTED)]
+    await repair_beatmaps(corrupted, manifest, job.log)
@@ -1,9 +1,21 @@
+import os
+import time
 from databases import Database
 from redis import Redis
 from app.objects.framework import Job, config
+from app.objects.resources import DB_HEAVY
 
+AGGREGATE_KEY = "ragnarok:cron:score_aggregate"
+# how often the running totals are thrown away and recounted from scratch,
+# to correct drift from deleted scores or awards_pp flips.
+RECONCILE_INTERVAL = int(os.getenv("SCORE_AGGREGATE_RECONCILE_INTERVAL", 86400))
 
-@config.register(name="repopulate_redis_cache", interval=300)  # every 5 minutes
+
+@config.register(
+    name="repopulate_redis_cache",
+    interval=300,  # every 5 minutes
+    resources=(DB_HEAVY,),
+)
 async def repopulate_redis_cache(job: Job, database: Database, redis: Redis) -> None:
     """
     `repopulate_redis_cache()` repopulates all server stats cached in redis.
@@ -11,23 +23,56 @@ async def repopulate_redis_cache(job: Job, database: Database, redis: Redis) ->
     and playmodes.
     """
 
-    print("starting to repopulate redis cache")
-    total_scores = await database.fetch_val("SELECT COUNT(*) FROM scores")
+    job.log.info("starting to repopulate redis cache")
+    aggregate = {
+        key.decode(): float(value)
+        for key, value in (await redis.hgetall(AGGREGATE_KEY)).items()
+    }
+
+    if time.time() - aggregate.get("reconciled_at", 0) >= RECONCILE_INTERVAL:
+        job.log.info("reconciling score totals with a full count")
+        last_id = await database.fetch_val("SELECT MAX(id) FROM scores") or 0
+        totals = await database.fetch_one(
+            "SELECT COUNT(*) AS total_scores, "
+            "SUM(CASE WHEN awards_pp = 1 THEN pp ELSE 0 END) AS total_pp "
+            "FROM scores WHERE id <= :last_id",
+            {"last_id": last_id},
+        )
+        assert totals is not None
 
-    if not total_scores:
-        print("failed to fetch scores?")
+        aggregate = {
+            "last_id": last_id,
+            "total_scores": totals["total_scores"],
+            "total_pp": float(totals["total_pp"] or 0),
+            "reconciled_at": time.time(),
+        }
     else:
-        await redis.set("ragnarok:total_scores", total_scores)
-        print("populated ragnarok:total_scores")
+        # only count the scores submitted since the last run.
+        delta = await database.fetch_one(
+            "SELECT COUNT(*) AS total_scores, MAX(id) AS last_id, "
+            "SUM(CASE WHEN awards_pp = 1 THEN pp ELSE 0 END) AS total_pp "
+            "FROM scores WHERE id > :last_id",
+            {"last_id": int(aggregate["last_id"])},
+        )
+        assert delta is not None
+
+        if delta["total_scores"]:
+            aggregate["last_id"] = delta["last_id"]
+            aggregate["total_scores"] += delta["total_scores"]
+            aggregate["total_pp"] += float(delta["total_pp"] or 0)
 
-    accumulated_pp = await database.fetch_val(
-        "SELECT SUM(pp) FROM scores WHERE awards_pp = 1"
-    )
+    await redis.hset(AGGREGATE_KEY, mapping=aggregate)
+
+    if not aggregate["total_scores"]:
+        job.log.warning("failed to fetch scores?")
+    else:
+        await redis.set("ragnarok:total_scores", int(aggregate["total_scores"]))
+        job.log.info("populated ragnarok:total_scores")
 
-    if not accumulated_pp:
-        print("failed to fetch pp?")
+    if not aggregate["total_pp"]:
+        job.log.warning("failed to fetch pp?")
     else:
-        await redis.set("ragnarok:total_pp", accumulated_pp)
-        print("populated ragnarok:total_pp")
+        await redis.set("ragnarok:total_pp", aggregate["total_pp"])
+        job.log.info("populated ragnarok:total_pp")
 
-    print("finished repopulating redis cache")
+    job.log.info("finished repopulating redis cache")
@@ -0,0 +1,50 @@
+import os
+from databases import Database
+from redis import Redis
+from app.jobs.recalculate_stats import recalculate_users
+from app.objects.framework import Job, config
+from app.objects.sql import bind_in
+
+# the server adds an event with the `user_id`, `gamemode` and `mode`
+# of every submitted score to this stream.
+SCORE_STREAM_KEY = os.getenv("SCORE_STREAM_KEY") or "ragnarok:score_submissions"
+SCORE_STREAM_DEBOUNCE = float(os.getenv("SCORE_STREAM_DEBOUNCE", 2))  # seconds
+
+
+@config.consumer(
+    name="recalculate_submitted_stats",
+    stream=SCORE_STREAM_KEY,
+    debounce=SCORE_STREAM_DEBOUNCE,
+)
+async def recalculate_submitted_stats(
+    job: Job, database: Database, redis: Redis, events: list[dict[str, str]]
+) -> None:
+    """
+    `recalculate_submitted_stats()` recalculates the pp and accuracy of
+    users right after they submit scores, only in the modes they played.
+    """
+    # a burst of submissions by the same user only recalculates them once.
+    submitted: set[tuple[int, int, int]] = set()
+
+    for event in events:
+        try:
+            submitted.add(
+                (int(event["user_id"]), int(event["gamemode"]), int(event["mode"]))
+            )
+        except (KeyError, ValueError):
+            job.log.warning("skipping malformed score submission event %s", event)
+
+    if not submitted:
+        return
+
+    user_ids = sorted({user_id for user_id, _, _ in submitted})
+
+    placeholders, values = bind_in("user_id", user_ids)
+    users = await database.fetch_all(
+        "SELECT id, country FROM users WHERE privileges & 4 "
+        f"AND id IN ({placeholders})",
+        values,
+    )
+
+    if users:
+        await recalculate_users(database, redis, users, only=submitted)
@@ -0,0 +1,56 @@
+from redis import Redis
+from app.objects.lease import eval_fenced
+
+FENCED_HSET_SCRIPT = """
+return redis.call("HSET", KEYS[2], ARGV[2], ARGV[3])
+"""
+FENCED_DEL_SCRIPT = """
+return redis.call("DEL", KEYS[2])
+"""
+
+
+class Checkpoint:
+    """
+    `Checkpoint` persists the progress of a job run in redis, so a run
+    that was interrupted by a restart or cancellation resumes where it
+    left off instead of starting over. It's cleared once a run finishes.
+    While `token` is set, it's only written as long as the run holds the
+    lease with that fencing token.
+    """
+
+    def __init__(self, redis: Redis, name: str) -> None:
+        self.redis = redis
+        self.name = name
+        self.key = f"ragnarok:cron:checkpoint:{name}"
+        self.token: int | None = None
+
+    async def exists(self) -> bool:
+        return bool(await self.redis.exists(self.key))
+
+    async def get(self, field: str = "cursor") -> str | None:
+        value = await self.redis.hget(self.key, field)
+        return value.decode() if value is not None else None
+
+    async def set(
+        self, value: str | int, field: str = "cursor", token: int | None = None
+    ) -> None:
+        """
+        `set()` writes a field of the checkpoint, fenced by `token` or
+        otherwise the token of the current run.
+        """
+        if (token := token or self.token) is None:
+            await self.redis.hset(self.key, field, value)
+            return
+
+        await eval_fenced(
+            self.redis, self.name, token, FENCED_HSET_SCRIPT, [self.key], [field, value]
+        )
+
+    async def clear(self) -> None:
+        if self.token is None:
+            await self.redis.delete(self.key)
+            return
+
+        await eval_fenced(
+            self.redis, self.name, self.token, FENCED_DEL_SCRIPT, [self.key]
+        )
@@ -0,0 +1,97 @@
+from datetime import datetime, timedelta
+
+# (minimum, maximum) of minute, hour, day of month, month and day of week.
+FIELD_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+
+def parse_field(field: str, minimum: int, maximum: int) -> set[int]:
+    values: set[int] = set()
+
+    for part in field.split(","):
+        step = 1
+
+        if "/" in part:
+            part, _step = part.split("/")
+            step = int(_step)
+
+        if part == "*":
+            start, end = minimum, maximum
+        elif "-" in part:
+            _start, _end = part.split("-")
+            start, end = int(_start), int(_end)
+        else:
+            start = int(part)
+            end = maximum if step != 1 else start
+
+        if start < minimum or end > maximum or start > end or step < 1:
+            raise ValueError(f"invalid cron field {field!r}")
+
+        values.update(range(start, end + 1, step))
+
+    return values
+
+
+class CronExpression:
+    """
+    `CronExpression` is a standard 5 field cron expression
+    (minute, hour, day of month, month, day of week).
+    """
+
+    def __init__(self, expression: str) -> None:
+        fields = expression.split()
+
+        if len(fields) != 5:
+            raise ValueError(f"cron expression {expression!r} must have 5 fields")
+
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            parse_field(field, *FIELD_RANGES[idx]) for idx, field in enumerate(fields)
+        )
+        # like cron, 7 is sunday as well
+        if 7 in self.weekdays:
+            self.weekdays = (self.weekdays - {7}) | {0}
+
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    def matches_day(self, date: datetime) -> bool:
+        in_days = date.day in self.days
+        # python starts the week on monday, cron on sunday.
+        in_weekdays = (date.weekday() + 1) % 7 in self.weekdays
+
+        # if both are restricted, cron runs when either of them matches.
+        if not self.any_day and not self.any_weekday:
+            return in_days or in_weekdays
+
+        return in_days and in_weekdays
+
+    def next_after(self, after: datetime) -> datetime:
+        """
+        `next_after()` returns the first time after `after` matching the expression.
+        """
+        current = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # every valid expression matches at least once within a few years.
+        limit = current + timedelta(days=366 * 5)
+
+        while current < limit:
+            if current.month not in self.months:
+                current = (current.replace(day=1) + timedelta(days=32)).replace(
+                    day=1, hour=0, minute=0
+                )
+                continue
+
+            if not self.matches_day(current):
+                current = current.replace(hour=0, minute=0) + timedelta(days=1)
+                continue
+
+            if current.hour not in self.hours:
+                current = current.replace(minute=0) + timedelta(hours=1)
+                continue
+
+            if current.minute not in self.minutes:
+                current += timedelta(minutes=1)
+                continue
+
+            return current
+
+        raise ValueError(f"cron expression {self.expression!r} never matches")
@@ -0,0 +1,21 @@
+from typing import Iterable
+from redis import Redis
+
+# kept apart from the stats calculation, so the jobs marking stats dirty
+# don't have to load numpy.
+DIRTY_STATS_KEY = "ragnarok:cron:dirty_stats"
+# the dirty stats taken by the running incremental recalculation.
+DIRTY_STATS_PROCESSING_KEY = "ragnarok:cron:dirty_stats:processing"
+
+
+async def mark_stats_dirty(
+    redis: Redis, entries: Iterable[tuple[int, int, int]]
+) -> None:
+    """
+    `mark_stats_dirty()` queues (user_id, gamemode, mode) pairs to be picked
+    up by the next incremental stats recalculation.
+    """
+    members = [f"{user_id}:{gamemode}:{mode}" for user_id, gamemode, mode in entries]
+
+    if members:
+        await redis.sadd(DIRTY_STATS_KEY, *members)
@@ -0,0 +1,149 @@
+from redis import Redis
+from app.objects.lease import eval_fenced
+
+LEADERBOARD_PREFIX = "ragnarok:leaderboard"
+STAGING_PREFIX = "ragnarok:staging:leaderboard"
+
+# ARGV[2] staging keys in KEYS are renamed onto the live keys following them,
+# the keys after those are deleted.
+FENCED_COMMIT_SCRIPT = """
+local renamed = tonumber(ARGV[2])
+for idx = 1, renamed do
+    redis.call("RENAME", KEYS[1 + idx], KEYS[1 + renamed + idx])
+end
+for idx = 2 + 2 * renamed, #KEYS do
+    redis.call("DEL", KEYS[idx])
+end
+return renamed
+"""
+
+
+def leaderboard_keys(gamemode: str, play_mode: int, country: str) -> tuple[str, str]:
+    """
+    `leaderboard_keys()` returns the global and country leaderboard key
+    of a gamemode and play mode.
+    """
+    return (
+        f"{LEADERBOARD_PREFIX}:{gamemode}:{play_mode}",
+        f"{LEADERBOARD_PREFIX}:{gamemode}:{country}:{play_mode}",
+    )
+
+
+async def write_leaderboards(
+    redis: Redis, leaderboards: dict[str, dict[str, float]]
+) -> None:
+    """
+    `write_leaderboards()` adds all members to their leaderboards
+    in a single pipelined round-trip.
+    """
+    if not leaderboards:
+        return
+
+    async with redis.pipeline(transaction=False) as pipe:
+        for key, mapping in leaderboards.items():
+            pipe.zadd(key, mapping)
+
+        await pipe.execute()
+
+
+async def remove_from_leaderboards(
+    redis: Redis, leaderboards: dict[str, list[str]]
+) -> None:
+    """
+    `remove_from_leaderboards()` removes all members from their leaderboards
+    in a single pipelined round-trip.
+    """
+    if not leaderboards:
+        return
+
+    async with redis.pipeline(transaction=False) as pipe:
+        for key, members in leaderboards.items():
+            pipe.zrem(key, *members)
+
+        await pipe.execute()
+
+
+class LeaderboardRebuild:
+    """
+    `LeaderboardRebuild` builds every leaderboard from scratch into staging
+    keys, and swaps them into place at once when the rebuild is committed.
+    Leaderboards that weren't rebuilt are removed, and so are the members
+    that weren't added again. As everything is staged in redis, a rebuild
+    can be spread over multiple instances and committed from any of them.
+    """
+
+    def __init__(self, redis: Redis, batch_size: int = 10_000) -> None:
+        self.redis = redis
+        self.batch_size = batch_size
+
+        self.pending: dict[str, dict[str, float]] = {}
+        self.pending_members = 0
+
+    async def begin(self) -> None:
+        # clean up staging keys left behind by a crashed rebuild.
+        stale = [key async for key in self.redis.scan_iter(f"{STAGING_PREFIX}:*")]
+
+        if stale:
+            await self.redis.delete(*stale)
+
+    async def add(self, key: str, member: str, score: float) -> None:
+        self.pending.setdefault(key, {})[member] = score
+        self.pending_members += 1
+
+        if self.pending_members >= self.batch_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        staging = {
+            STAGING_PREFIX + key.removeprefix(LEADERBOARD_PREFIX): mapping
+            for key, mapping in self.pending.items()
+        }
+        await write_leaderboards(self.redis, staging)
+
+        self.pending = {}
+        self.pending_members = 0
+
+    async def commit(self, name: str | None = None, token: int | None = None) -> None:
+        """
+        `commit()` swaps the rebuilt leaderboards into place, only if the
+        lease of job `name` still has the fencing `token` when it's given.
+        """
+        await self.flush()
+
+        rebuilt = {
+            LEADERBOARD_PREFIX + key.decode().removeprefix(STAGING_PREFIX)
+            async for key in self.redis.scan_iter(f"{STAGING_PREFIX}:*")
+        }
+        live = [
+            key.decode()
+            async for key in self.redis.scan_iter(f"{LEADERBOARD_PREFIX}:*")
+        ]
+
+        if name is not None and token is not None:
+            renamed = sorted(rebuilt)
+            await eval_fenced(
+                self.redis,
+                name,
+                token,
+                FENCED_COMMIT_SCRIPT,
+                [
+                    *(
+                        STAGING_PREFIX + key.removeprefix(LEADERBOARD_PREFIX)
+                        for key in renamed
+                    ),
+                    *renamed,
+                    *(key for key in live if key not in rebuilt),
+                ],
+                [len(renamed)],
+            )
+            return
+
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for key in rebuilt:
+                pipe.rename(STAGING_PREFIX + key.removeprefix(LEADERBOARD_PREFIX), key)
+
+            for key in live:
+                if key not in rebuilt:
+                    pipe.delete(key)
+
+            await pipe.execute()
@@ -0,0 +1,173 @@
+import asyncio
+import os
+import socket
+from datetime import datetime
+from typing import Any, Sequence
+from redis import Redis
+from redis.exceptions import ResponseError
+from app.objects.logs import job_logger
+
+NODE_ID = os.getenv("CRON_NODE_ID") or f"{socket.gethostname()}:{os.getpid()}"
+
+LEASE_TTL = int(os.getenv("CRON_LEASE_TTL", 30))  # seconds
+
+RENEW_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+# prefixes fenced scripts, which only go on if the lease in KEYS[1] still
+# carries the fencing token in ARGV[1].
+FENCE_CHECK = """
+local lease = redis.call("GET", KEYS[1])
+if not lease or string.match(lease, "|(%d+)$") ~= ARGV[1] then
+    return redis.error_reply("FENCED lease lost")
+end
+"""
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def lease_key(name: str) -> str:
+    return f"ragnarok:cron:lease:{name}"
+
+
+def cancel_key(name: str) -> str:
+    return f"ragnarok:cron:cancel:{name}"
+
+
+class JobLease:
+    """
+    `JobLease` makes sure a job only runs on a single cron node at a time.
+    Every acquired lease gets a fencing token that's higher than any before
+    it, and the lease has to be renewed through `heartbeat()` or it expires,
+    so a crashed node releases its jobs quickly. Checkpoints and leaderboard
+    commits are written through `eval_fenced()`, so a node that lost its
+    lease while paused can't overwrite them. Database writes aren't fenced.
+    """
+
+    def __init__(self, redis: Redis, name: str, ttl: int = LEASE_TTL) -> None:
+        self.redis = redis
+        self.name = name
+        self.ttl = ttl
+        self.token: int | None = None
+
+    @property
+    def value(self) -> str:
+        return f"{NODE_ID}|{self.token}"
+
+    async def acquire(self) -> bool:
+        self.token = await self.redis.incr(f"ragnarok:cron:fence:{self.name}")
+
+        if not await self.redis.set(
+            lease_key(self.name), self.value, px=self.ttl * 1000, nx=True
+        ):
+            return False
+
+        # a cancel request left over from an earlier run doesn't apply to this one.
+        await self.redis.delete(cancel_key(self.name))
+        return True
+
+    async def renew(self) -> bool:
+        return bool(
+            await self.redis.eval(
+                RENEW_SCRIPT, 1, lease_key(self.name), self.value, self.ttl * 1000
+            )
+        )
+
+    async def release(self) -> None:
+        await self.redis.eval(RELEASE_SCRIPT, 1, lease_key(self.name), self.value)
+
+    async def heartbeat(self, holder: asyncio.Task) -> None:
+        """
+        `heartbeat()` keeps renewing the lease, and cancels `holder`
+        if it was lost to another node or another node asked to cancel it.
+        """
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+
+            if not await self.renew():
+                job_logger(self.name).warning("lost its lease, cancelling the run")
+                holder.cancel()
+                return
+
+            if await self.redis.delete(cancel_key(self.name)):
+                job_logger(self.name).warning("cancel requested, cancelling the run")
+                holder.cancel()
+                return
+
+
+async def eval_fenced(
+    redis: Redis,
+    name: str,
+    token: int,
+    script: str,
+    keys: Sequence[str] = (),
+    args: Sequence[Any] = (),
+) -> Any:
+    """
+    `eval_fenced()` runs `script` only if the lease of job `name` still has
+    the fencing `token`, and raises `LeaseLost` otherwise. Its own keys start
+    at KEYS[2] and its arguments at ARGV[2].
+    """
+    try:
+        return await redis.eval(
+            FENCE_CHECK + script, 1 + len(keys), lease_key(name), *keys, token, *args
+        )
+    except ResponseError as exc:
+        if "FENCED" not in str(exc):
+            raise
+
+        raise LeaseLost(f"{name} lost the lease of run {token}") from exc
+
+
+async def claim_run(redis: Redis, name: str, scheduled_at: datetime, ttl: int) -> bool:
+    """
+    `claim_run()` claims a scheduled run of a job, so only the first node
+    that fires it runs it.
+    """
+    return bool(
+        await redis.set(
+            f"ragnarok:cron:run:{name}:{int(scheduled_at.timestamp())}",
+            NODE_ID,
+            ex=max(ttl, LEASE_TTL),
+            nx=True,
+        )
+    )
+
+
+async def lease_holders(redis: Redis, names: list[str]) -> dict[str, str | None]:
+    """
+    `lease_holders()` returns the node currently running each job, if any.
+    """
+    async with redis.pipeline(transaction=False) as pipe:
+        for name in names:
+            pipe.get(lease_key(name))
+
+        values = await pipe.execute()
+
+    return {
+        name: value.decode().split("|")[0] if value is not None else None
+        for name, value in zip(names, values)
+    }
+
+
+async def request_cancel(redis: Redis, name: str) -> bool:
+    """
+    `request_cancel()` asks the node running a job to cancel it, which it
+    picks up on its next heartbeat. returns False if the job isn't running.
+    """
+    if not await redis.exists(lease_key(name)):
+        return False
+
+    await redis.set(cancel_key(name), NODE_ID, ex=LEASE_TTL)
+    return True
@@ -0,0 +1,184 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_LEVEL = os.getenv("CRON_LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("CRON_LOG_FORMAT", "text")  # or "json"
+# repeated messages below warnings are only logged once per this many seconds.
+LOG_SAMPLE_INTERVAL = float(os.getenv("CRON_LOG_SAMPLE_INTERVAL", 5))
+PROGRESS_INTERVAL = float(os.getenv("CRON_PROGRESS_INTERVAL", 30))
+
+
+def job_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"cron.{name}")
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": record.created,
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "message": record.getMessage(),
+        } | getattr(record, "fields", {})
+
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self) -> None:
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = getattr(record, "fields", {})
+        line = super().format(record)
+
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+
+        return line
+
+
+class SampleFilter(logging.Filter):
+    """
+    `SampleFilter` lets through a message logged over and over only once
+    every `interval` seconds. The next one that's let through tells how
+    many were suppressed. Warnings and errors always are, and so are
+    records logged with `extra={"sample": False}`.
+    """
+
+    # past this many distinct messages, the ones not seen for an interval are
+    # forgotten, and then the oldest ones until half of them are left.
+    MAX_SEEN = 1024
+
+    def __init__(self, interval: float = LOG_SAMPLE_INTERVAL) -> None:
+        super().__init__()
+        self.interval = interval
+        self.seen: dict[tuple[str, str], tuple[float, int]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self.interval <= 0:
+            return True
+
+        if not getattr(record, "sample", True):
+            return True
+
+        # messages are told apart by their format string, so a line logged
+        # for every item counts as one message whatever its arguments are.
+        key = (record.name, str(record.msg))
+        now = time.monotonic()
+        logged_at, suppressed = self.seen.get(key, (0.0, 0))
+
+        if len(self.seen) > self.MAX_SEEN:
+            self.seen = {
+                seen: entry
+                for seen, entry in self.seen.items()
+                if now - entry[0] < self.interval
+            }
+
+            while len(self.seen) > self.MAX_SEEN // 2:
+                del self.seen[next(iter(self.seen))]
+
+        if now - logged_at < self.interval:
+            self.seen[key] = (logged_at, suppressed + 1)
+            return False
+
+        self.seen[key] = (now, 0)
+
+        if suppressed:
+            record.fields = getattr(record, "fields", {}) | {"suppressed": suppressed}
+
+        return True
+
+
+def setup_logging() -> None:
+    """
+    `setup_logging()` sends all logs through a queue to a background thread,
+    so writing them never blocks the event loop.
+    """
+    records: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+
+    handler = QueueHandler(records)
+    handler.addFilter(SampleFilter())
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(handler)
+
+    listener = QueueListener(records, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+
+class Progress:
+    """
+    `Progress` logs how far along a job is, how fast it's going and when
+    it should be done, at most once every `interval` seconds.
+    """
+
+    def __init__(
+        self,
+        log: logging.Logger,
+        what: str,
+        total: int | None = None,
+        interval: float = PROGRESS_INTERVAL,
+    ) -> None:
+        self.log = log
+        self.what = what
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.started_at = self.logged_at = time.monotonic()
+
+    def advance(self, count: int = 1) -> None:
+        self.update(self.done + count)
+
+    def update(self, done: int) -> None:
+        self.done = done
+
+        if time.monotonic() - self.logged_at >= self.interval:
+            self.report()
+
+    def report(self) -> None:
+        now = time.monotonic()
+        self.logged_at = now
+
+        rate = self.done / max(now - self.started_at, 1e-9)
+        fields: dict[str, int | float | str] = {
+            "done": self.done,
+            "rate": round(rate, 1),
+        }
+
+        if self.total is not None:
+            fields["total"] = self.total
+
+            if rate > 0:
+                fields["eta"] = f"{max(self.total - self.done, 0) / rate:.0f}s"
+
+        # progress reports are already spaced out, so they aren't sampled.
+        self.log.info(
+            "%s in progress", self.what, extra={"fields": fields, "sample": False}
+        )
+
+    def finish(self) -> None:
+        elapsed = time.monotonic() - self.started_at
+        self.log.info(
+            "%s finished",
+            self.what,
+            extra={
+                "fields": {
+                    "done": self.done,
+                    "elapsed": f"{elapsed:.1f}s",
+                    "rate": round(self.done / max(elapsed, 1e-9), 1),
+                },
+                "sample": False,
+            },
+        )
@@ -0,0 +1,85 @@
+import os
+import pickle
+import time
+from enum import IntEnum, unique
+from pathlib import Path
+
+# the manifest is rewritten whole, so long scans only checkpoint it this often.
+SAVE_INTERVAL = 60  # seconds
+
+
+@unique
+class Verdict(IntEnum):
+    VALID = 0
+    CORRUPTED = 1
+
+
+class ScanManifest:
+    """
+    `ScanManifest` remembers the size, mtime and verdict of every file in a
+    directory between runs, so only new or modified files have to be read.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.entries: dict[str, tuple[int, int, int]] = {}
+        self.saved_at = time.monotonic()
+
+    def load(self) -> None:
+        if not self.path.exists():
+            return
+
+        try:
+            with self.path.open("rb") as f:
+                self.entries = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            # a broken manifest only means everything gets checked again.
+            self.entries = {}
+
+    def save(self) -> None:
+        # write it next to the old one first, so a crash
+        # never leaves a half written manifest behind.
+        temporary = self.path.with_name(self.path.name + ".tmp")
+
+        with temporary.open("wb") as f:
+            pickle.dump(self.entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(temporary, self.path)
+        self.saved_at = time.monotonic()
+
+    def save_due(self) -> bool:
+        return time.monotonic() - self.saved_at >= SAVE_INTERVAL
+
+    def scan(self, directory: Path, suffix: str) -> list[tuple[str, int, int]]:
+        """
+        `scan()` stats every file in `directory`, forgets the files that were
+        removed and returns the (name, size, mtime_ns) of new or modified ones.
+        """
+        changed = []
+        seen = set()
+
+        with os.scandir(directory) as it:
+            for entry in it:
+                if not entry.name.endswith(suffix) or not entry.is_file():
+                    continue
+
+                stat = entry.stat()
+                seen.add(entry.name)
+                known = self.entries.get(entry.name)
+
+                if known is None or known[:2] != (stat.st_size, stat.st_mtime_ns):
+                    changed.append((entry.name, stat.st_size, stat.st_mtime_ns))
+
+        for name in self.entries.keys() - seen:
+            del self.entries[name]
+
+        return changed
+
+    def update(self, name: str, size: int, mtime_ns: int, verdict: Verdict) -> None:
+        self.entries[name] = (size, mtime_ns, int(verdict))
+
+    def forget(self, name: str) -> None:
+        self.entries.pop(name, None)
+
+    def with_verdict(self, verdict: Verdict) -> list[str]:
+        return [name for name, entry in self.entries.items() if entry[2] == verdict]
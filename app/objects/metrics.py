@@ -0,0 +1,266 @@
+import bisect
+import inspect
+import math
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Mapping
+from app.objects.profiler import SqlProfile, fingerprint, result_rows
+from app.objects.tracing import traced
+
+# run duration buckets in seconds, from a cache refresh up to a full recalculation.
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 300, 900, 1800, 3600, 7200, 14400, math.inf)
+
+QUERY_METHODS = ("execute", "execute_many", "fetch_all", "fetch_one", "fetch_val")
+
+
+@dataclass
+class JobMetrics:
+    successes: int = 0
+    failures: int = 0
+    duration_buckets: list[int] = field(
+        default_factory=lambda: [0] * len(DURATION_BUCKETS)
+    )
+    duration_sum: float = 0
+    last_run: float = 0
+    last_success: float = 0
+
+    db_queries: int = 0
+    db_seconds: float = 0
+    redis_commands: int = 0
+    redis_seconds: float = 0
+
+    def observe_run(self, started_at: float, duration: float, success: bool) -> None:
+        self.duration_buckets[bisect.bisect_left(DURATION_BUCKETS, duration)] += 1
+        self.duration_sum += duration
+        self.last_run = started_at
+
+        if success:
+            self.successes += 1
+            self.last_success = started_at
+        else:
+            self.failures += 1
+
+    def observe_query(self, duration: float) -> None:
+        self.db_queries += 1
+        self.db_seconds += duration
+
+    def observe_command(self, duration: float) -> None:
+        self.redis_commands += 1
+        self.redis_seconds += duration
+
+
+def timed(method: Callable, observe: Callable[[float], None]) -> Callable:
+    async def wrapper(*args, **kwargs) -> Any:
+        started_at = time.perf_counter()
+
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            observe(time.perf_counter() - started_at)
+
+    return wrapper
+
+
+def profiled(
+    method: Callable, name: str, metrics: JobMetrics, profile: SqlProfile
+) -> Callable:
+    async def wrapper(
+        query: Any, values: Mapping[str, Any] | None = None, *args, **kwargs
+    ) -> Any:
+        started_at = time.perf_counter()
+        result = None
+
+        try:
+            result = await method(query, values, *args, **kwargs)
+            return result
+        finally:
+            duration = time.perf_counter() - started_at
+            metrics.observe_query(duration)
+            profile.observe(
+                query,
+                # execute_many takes a list of them, which can't be explained.
+                values if name != "execute_many" else None,
+                duration,
+                result_rows(name, result),
+            )
+
+    return wrapper
+
+
+def describe_query(*args, **kwargs) -> dict[str, Any]:
+    return {"query": fingerprint(kwargs["query"] if "query" in kwargs else args[0])}
+
+
+class InstrumentedConnection:
+    """
+    `InstrumentedConnection` wraps a `databases` connection, or the `Database`
+    itself, and times every query that goes through it. With a `profile`,
+    every statement is recorded in it too.
+    """
+
+    def __init__(
+        self, wrapped: Any, metrics: JobMetrics, profile: SqlProfile | None = None
+    ) -> None:
+        self.wrapped = wrapped
+        self.metrics = metrics
+        self.profile = profile
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self.wrapped, name)
+
+        if name in QUERY_METHODS:
+            if self.profile is not None:
+                method = profiled(attribute, name, self.metrics, self.profile)
+            else:
+                method = timed(attribute, self.metrics.observe_query)
+
+            return traced(method, "db", name, describe_query)
+
+        return attribute
+
+    async def iterate(self, query: Any, values: Mapping[str, Any] | None = None):
+        started_at = time.perf_counter()
+        rows = 0
+
+        try:
+            async for row in self.wrapped.iterate(query, values):
+                rows += 1
+                yield row
+        finally:
+            duration = time.perf_counter() - started_at
+            self.metrics.observe_query(duration)
+
+            if self.profile is not None:
+                self.profile.observe(query, values, duration, rows)
+
+    async def __aenter__(self) -> "InstrumentedConnection":
+        await self.wrapped.__aenter__()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.wrapped.__aexit__(*args)
+
+
+class InstrumentedDatabase(InstrumentedConnection):
+    def connection(self) -> InstrumentedConnection:
+        return InstrumentedConnection(
+            self.wrapped.connection(), self.metrics, self.profile
+        )
+
+
+class InstrumentedPipeline:
+    """
+    `InstrumentedPipeline` times a redis pipeline as a single command,
+    as that's a single round-trip.
+    """
+
+    def __init__(self, wrapped: Any, metrics: JobMetrics) -> None:
+        self.wrapped = wrapped
+        self.metrics = metrics
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self.wrapped, name)
+
+        if name == "execute":
+            return traced(
+                timed(attribute, self.metrics.observe_command),
+                "redis",
+                "pipeline",
+                lambda *_, **__: {"commands": len(self.wrapped.command_stack)},
+            )
+
+        return attribute
+
+    async def __aenter__(self) -> "InstrumentedPipeline":
+        await self.wrapped.__aenter__()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.wrapped.__aexit__(*args)
+
+
+class InstrumentedRedis:
+    """
+    `InstrumentedRedis` wraps an async redis client and times every command.
+    """
+
+    def __init__(self, wrapped: Any, metrics: JobMetrics) -> None:
+        self.wrapped = wrapped
+        self.metrics = metrics
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self.wrapped, name)
+
+        if name == "pipeline":
+            return lambda *args, **kwargs: InstrumentedPipeline(
+                attribute(*args, **kwargs), self.metrics
+            )
+
+        if not callable(attribute):
+            return attribute
+
+        # redis commands are plain methods returning awaitables, so
+        # only time the calls that actually go to the server.
+        def command(*args, **kwargs) -> Any:
+            result = attribute(*args, **kwargs)
+
+            if inspect.isawaitable(result):
+                return traced(
+                    timed(lambda: result, self.metrics.observe_command), "redis", name
+                )()
+
+            return result
+
+        return command
+
+
+def render_metrics(metrics: dict[str, JobMetrics]) -> str:
+    """
+    `render_metrics()` renders the metrics of every job in the
+    prometheus text format.
+    """
+    lines = []
+
+    def family(name: str, kind: str, description: str) -> None:
+        lines.append(f"# HELP cron_job_{name} {description}")
+        lines.append(f"# TYPE cron_job_{name} {kind}")
+
+    family("runs_total", "counter", "Finished job runs.")
+    for job, m in metrics.items():
+        for status, count in (("success", m.successes), ("failure", m.failures)):
+            lines.append(
+                f'cron_job_runs_total{{job="{job}",status="{status}"}} {count}'
+            )
+
+    family("duration_seconds", "histogram", "Job run duration.")
+    for job, m in metrics.items():
+        cumulative = 0
+
+        for bucket, count in zip(DURATION_BUCKETS, m.duration_buckets):
+            cumulative += count
+            le = "+Inf" if bucket == math.inf else bucket
+            lines.append(
+                f'cron_job_duration_seconds_bucket{{job="{job}",le="{le}"}} {cumulative}'
+            )
+
+        lines.append(f'cron_job_duration_seconds_sum{{job="{job}"}} {m.duration_sum}')
+        lines.append(f'cron_job_duration_seconds_count{{job="{job}"}} {cumulative}')
+
+    for name, kind, description, attribute in (
+        ("last_run_timestamp_seconds", "gauge", "Start of the last run.", "last_run"),
+        (
+            "last_success_timestamp_seconds",
+            "gauge",
+            "Start of the last successful run.",
+            "last_success",
+        ),
+        ("db_queries_total", "counter", "Database queries issued.", "db_queries"),
+        ("db_seconds_total", "counter", "Time spent on the database.", "db_seconds"),
+        ("redis_commands_total", "counter", "Redis round-trips.", "redis_commands"),
+        ("redis_seconds_total", "counter", "Time spent on redis.", "redis_seconds"),
+    ):
+        family(name, kind, description)
+        for job, m in metrics.items():
+            lines.append(f'cron_job_{name}{{job="{job}"}} {getattr(m, attribute)}')
+
+    return "\n".join(lines) + "\n"
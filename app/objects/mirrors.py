@@ -0,0 +1,268 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Awaitable, Callable, Iterable, Mapping
+from app.objects.tracing import span
+
+if TYPE_CHECKING:
+    import aiohttp
+
+DEFAULT_PAUSE = 90  # seconds to back off when a mirror doesn't say how long
+MAX_PAUSE = 300  # seconds, whatever a mirror says
+# reset times past this are unix timestamps rather than seconds from now.
+EPOCH_CUTOFF = 1_000_000_000
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    `TokenBucket` limits how fast requests are sent to a single host. It
+    refills at `rate` tokens per second, and can be paused entirely when
+    the host tells us we've hit its ratelimit.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    @property
+    def paused(self) -> bool:
+        return self.paused_until > time.monotonic()
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self, wait_paused: bool = True) -> bool:
+        """
+        `acquire()` waits for a token, and returns False without one if the
+        bucket is paused and we don't want to wait for it.
+        """
+        while True:
+            # checked before queueing on the lock, so skipping a paused
+            # bucket never waits on the ones waiting it out.
+            if self.paused:
+                if not wait_paused:
+                    return False
+
+                await asyncio.sleep(self.paused_until - time.monotonic())
+                continue
+
+            async with self.lock:
+                self.refill()
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+
+                wait = (1 - self.tokens) / self.rate
+
+            # slept outside of the lock, the bucket may be paused meanwhile.
+            await asyncio.sleep(wait)
+
+    def update(self, headers: Mapping[str, str]) -> None:
+        """
+        `update()` adjusts the bucket to the (lowercased) ratelimit
+        headers a host returned.
+        """
+        if (limit := headers.get("x-ratelimit-limit")) and limit.isdigit():
+            self.capacity = max(1, int(limit))
+
+        remaining = headers.get("x-ratelimit-remaining")
+
+        if remaining is None or not remaining.isdigit():
+            return
+
+        self.tokens = min(self.tokens, int(remaining))
+
+        # stop right before the host starts answering with 429, so
+        # our ip doesn't get automatically banned.
+        if int(remaining) <= 1:
+            self.pause(retry_after(headers))
+
+
+def retry_after(headers: Mapping[str, str]) -> float:
+    for key in ("retry-after", "x-ratelimit-reset"):
+        if (value := headers.get(key)) and value.isdigit():
+            seconds = float(value)
+
+            # many mirrors send the time the limit resets at instead.
+            if seconds > EPOCH_CUTOFF:
+                seconds -= time.time()
+
+            return min(max(seconds, 0.0), MAX_PAUSE)
+
+    return DEFAULT_PAUSE
+
+
+@dataclass
+class DotOsuEndpoint:
+    host: str
+    endpoint: str
+    rate: float  # requests per second
+    capacity: float = 1
+    corrected_files: int = 0
+    bucket: TokenBucket = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.bucket = TokenBucket(self.rate, self.capacity)
+
+
+class MirrorFetcher:
+    """
+    `MirrorFetcher` downloads .osu files with a bounded pool of workers over
+    a shared connector. Mirrors are tried in priority order, skipping the
+    ones that are currently ratelimited.
+    """
+
+    def __init__(
+        self,
+        mirrors: Iterable[DotOsuEndpoint],
+        workers: int = 8,
+        retries: int = 3,
+        backoff: float = 1.0,
+    ) -> None:
+        self.mirrors = tuple(mirrors)
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.session: "aiohttp.ClientSession | None" = None
+
+    async def __aenter__(self) -> "MirrorFetcher":
+        # aiohttp is only loaded once something is actually fetched.
+        import aiohttp
+
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.workers),
+            timeout=aiohttp.ClientTimeout(total=30),
+        )
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        if self.session is not None:
+            await self.session.close()
+
+    async def request(
+        self, mirror: DotOsuEndpoint, map_id: str, wait_paused: bool
+    ) -> str | None:
+        import aiohttp
+
+        assert self.session is not None
+
+        for attempt in range(self.retries):
+            if not await mirror.bucket.acquire(wait_paused):
+                return None
+
+            try:
+                with span("fetch", "mirror", host=mirror.host, map_id=map_id):
+                    async with self.session.get(
+                        mirror.endpoint.format(map_id=map_id)
+                    ) as response:
+                        headers = {k.lower(): v for k, v in response.headers.items()}
+                        mirror.bucket.update(headers)
+
+                        # ratelimited, pause and let the next mirror handle it.
+                        if response.status == 429:
+                            mirror.bucket.pause(retry_after(headers))
+                            log.info(
+                                "%s: reached ratelimit and will continue to the other mirror",
+                                mirror.host,
+                            )
+                            return None
+
+                        if response.status >= 500:
+                            raise aiohttp.ClientResponseError(
+                                response.request_info, (), status=response.status
+                            )
+
+                        if response.status != 200:
+                            # mino does handle it correctly and returns 404 if
+                            # the beatmap doesn't exist.
+                            log.info(
+                                "%s: beatmap %s returned status %d",
+                                mirror.host,
+                                map_id,
+                                response.status,
+                            )
+                            return None
+
+                        decoded = await response.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                log.info(
+                    "%s: failed to fetch %s (%r), retrying", mirror.host, map_id, exc
+                )
+                await asyncio.sleep(self.backoff * 2**attempt)
+                continue
+
+            # even if the map doesn't exist on bancho, it'll still return 200
+            # therefore we need to check if the response text is empty.
+            if decoded == "":
+                log.info(
+                    "%s: beatmap %s doesn't exist, checking mirror", mirror.host, map_id
+                )
+                return None
+
+            if "nginx" in decoded:
+                log.warning(
+                    "%s: unhandled response for beatmap %s", mirror.host, map_id
+                )
+                return None
+
+            return decoded
+
+        return None
+
+    async def fetch(self, map_id: str) -> tuple[DotOsuEndpoint, str] | None:
+        """
+        `fetch()` fetches a .osu file from the first mirror that has it.
+        """
+        for mirror in self.mirrors:
+            # skip ratelimited mirrors, unless every one of them is.
+            wait_paused = all(m.bucket.paused for m in self.mirrors)
+
+            if (decoded := await self.request(mirror, map_id, wait_paused)) is not None:
+                return mirror, decoded
+
+        return None
+
+    async def run(
+        self,
+        map_ids: Iterable[str],
+        on_fetched: Callable[[str, DotOsuEndpoint, str], Awaitable[None]],
+    ) -> None:
+        """
+        `run()` fetches all given maps with the worker pool, and calls
+        `on_fetched` for every map that could be fetched. A map that fails
+        is logged and skipped, so it doesn't stop the other workers.
+        """
+        queue: asyncio.Queue[str] = asyncio.Queue()
+
+        for map_id in map_ids:
+            queue.put_nowait(map_id)
+
+        async def worker() -> None:
+            while not queue.empty():
+                map_id = queue.get_nowait()
+
+                try:
+                    if (fetched := await self.fetch(map_id)) is not None:
+                        mirror, decoded = fetched
+                        await on_fetched(map_id, mirror, decoded)
+                        mirror.corrected_files += 1
+                except Exception as exc:
+                    log.warning("failed to replace beatmap %s", map_id, exc_info=exc)
+
+        await asyncio.gather(*(worker() for _ in range(self.workers)))
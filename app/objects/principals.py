@@ -0,0 +1,91 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+from redis import Redis
+
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", 1024))
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", 30))  # seconds
+
+# the server publishes a user id here whenever their privileges change,
+# or "*" to drop every cached user.
+PRINCIPAL_INVALIDATE_CHANNEL = "ragnarok:principal_invalidate"
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class Principal:
+    username: str
+    privileges: int
+
+
+class PrincipalCache:
+    """
+    `PrincipalCache` keeps the users behind recently used tokens in memory
+    for a short while, so API requests don't each have to query the
+    database. Unknown users are cached too, as they'd query it just the same.
+    """
+
+    def __init__(
+        self, size: int = PRINCIPAL_CACHE_SIZE, ttl: float = PRINCIPAL_CACHE_TTL
+    ) -> None:
+        self.size = size
+        self.ttl = ttl
+        self.entries: OrderedDict[str, tuple[float, Principal | None]] = OrderedDict()
+
+    async def get(
+        self, user_id: str, fetch: Callable[[], Awaitable[Principal | None]]
+    ) -> Principal | None:
+        """
+        `get()` returns the cached user, or calls `fetch` and caches
+        its result if it isn't cached or has expired.
+        """
+        now = time.monotonic()
+
+        if (entry := self.entries.get(user_id)) is not None and entry[0] > now:
+            self.entries.move_to_end(user_id)
+            return entry[1]
+
+        principal = await fetch()
+        self.entries[user_id] = (now + self.ttl, principal)
+        self.entries.move_to_end(user_id)
+
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+        return principal
+
+    def invalidate(self, user_id: str | None = None) -> None:
+        if user_id is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(user_id, None)
+
+    async def listen(self, redis: Redis) -> None:
+        """
+        `listen()` drops cached users as their invalidations are published.
+        """
+        while True:
+            try:
+                async with redis.pubsub() as pubsub:
+                    await pubsub.subscribe(PRINCIPAL_INVALIDATE_CHANNEL)
+                    # anything might've changed while we weren't subscribed.
+                    self.invalidate()
+
+                    async for message in pubsub.listen():
+                        if message["type"] != "message":
+                            continue
+
+                        user_id = message["data"].decode()
+                        self.invalidate(None if user_id == "*" else user_id)
+            except Exception as exc:
+                log.warning("lost principal invalidations (%r), resubscribing", exc)
+                self.invalidate()
+                await asyncio.sleep(1)
+
+
+principals = PrincipalCache()
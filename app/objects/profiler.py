@@ -0,0 +1,218 @@
+import bisect
+import json
+import logging
+import math
+import os
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Any, Mapping
+from databases import Database
+from redis import Redis
+
+# job names to profile the queries of, or "*" for all of them.
+SQL_PROFILE_JOBS = {
+    name.strip()
+    for name in os.getenv("CRON_SQL_PROFILE", "").split(",")
+    if name.strip()
+}
+# how many of the most expensive statements are explained after a run.
+SQL_PROFILE_EXPLAIN = int(os.getenv("CRON_SQL_PROFILE_EXPLAIN", 5))
+SLOW_QUERY_SECONDS = float(os.getenv("CRON_SLOW_QUERY_SECONDS", 1))
+
+EXPLAINABLE = ("SELECT", "UPDATE", "DELETE")
+
+# query duration buckets in seconds, 10% apart from 0.1ms up to two minutes,
+# so the p95 of a statement is known within 10% without keeping every duration.
+QUERY_BUCKETS = tuple(0.0001 * 1.1**exponent for exponent in range(147)) + (math.inf,)
+
+STRING_LITERAL = re.compile(r"'(?:[^'\\]|\\.)*'")
+NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+PLACEHOLDER = re.compile(r":\w+")
+VALUE_TUPLE = r"\(\s*\?(?:\s*,\s*\?)*\s*\)"
+IN_LIST = re.compile(rf"\bIN {VALUE_TUPLE}", re.IGNORECASE)
+VALUE_ROWS = re.compile(
+    rf"\bVALUES {VALUE_TUPLE}(?:\s*,\s*{VALUE_TUPLE})*", re.IGNORECASE
+)
+CASE_ARMS = re.compile(r"WHEN \? THEN \?(?: WHEN \? THEN \?)+")
+
+
+def profile_key(name: str) -> str:
+    return f"ragnarok:cron:sql_profile:{name}"
+
+
+def is_profiled(name: str) -> bool:
+    return "*" in SQL_PROFILE_JOBS or name in SQL_PROFILE_JOBS
+
+
+def fingerprint(query: str) -> str:
+    """
+    `fingerprint()` normalises a statement, so statements that only differ
+    in their values or the length of their value lists are grouped together.
+    """
+    query = " ".join(str(query).split())
+    query = STRING_LITERAL.sub("?", query)
+    query = PLACEHOLDER.sub("?", query)
+    query = NUMBER_LITERAL.sub("?", query)
+    query = IN_LIST.sub("IN (?+)", query)
+    query = VALUE_ROWS.sub("VALUES (?+)+", query)
+    return CASE_ARMS.sub("WHEN ? THEN ? ...", query)
+
+
+def explain_flags(plan: list[dict[str, Any]]) -> list[str]:
+    """
+    `explain_flags()` points out the steps of a MySQL query plan that
+    are likely missing an index.
+    """
+    flags = []
+
+    for step in plan:
+        table = step.get("table")
+        extra = step.get("Extra") or ""
+
+        if step.get("type") == "ALL":
+            flags.append(f"full scan of {table} ({step.get("rows")} rows)")
+
+        if "Using filesort" in extra:
+            flags.append(f"filesort on {table}")
+
+        if "Using temporary" in extra:
+            flags.append(f"temporary table for {table}")
+
+    return flags
+
+
+@dataclass
+class QueryStats:
+    query: str
+    values: Mapping[str, Any] | None
+    slowest: float = 0
+    count: int = 0
+    total: float = 0
+    rows: int = 0
+    buckets: list[int] = field(default_factory=lambda: [0] * len(QUERY_BUCKETS))
+
+    def observe(self, duration: float) -> None:
+        self.count += 1
+        self.total += duration
+        self.buckets[bisect.bisect_left(QUERY_BUCKETS, duration)] += 1
+
+    @property
+    def p95(self) -> float:
+        # the upper bound of the bucket the 95th percentile falls in.
+        rank = math.ceil(self.count * 0.95)
+        seen = 0
+
+        for bound, count in zip(QUERY_BUCKETS, self.buckets):
+            seen += count
+
+            if seen >= rank:
+                return min(bound, self.slowest)
+
+        return self.slowest
+
+
+class SqlProfile:
+    """
+    `SqlProfile` collects the statements of a single job run by fingerprint,
+    with how often they ran, how long they took and how many rows they
+    returned. Once the run is over, the most expensive ones are explained.
+    """
+
+    def __init__(self, log: logging.Logger) -> None:
+        self.log = log
+        self.started_at = time.time()
+        self.statements: dict[str, QueryStats] = {}
+        self.plans: dict[str, dict[str, Any]] = {}
+
+    def observe(
+        self,
+        query: Any,
+        values: Mapping[str, Any] | None,
+        duration: float,
+        rows: int,
+    ) -> None:
+        key = fingerprint(query)
+
+        if (stats := self.statements.get(key)) is None:
+            stats = self.statements[key] = QueryStats(str(query), values)
+
+        stats.observe(duration)
+        stats.rows += rows
+
+        if duration > stats.slowest:
+            # the slowest one is explained, as it's the one worth fixing.
+            stats.query, stats.values, stats.slowest = str(query), values, duration
+
+        if duration >= SLOW_QUERY_SECONDS:
+            self.log.warning(
+                "slow query",
+                extra={"fields": {"query": key, "duration": round(duration, 3)}},
+            )
+
+    async def explain(self, database: Database, top: int = SQL_PROFILE_EXPLAIN) -> None:
+        """
+        `explain()` explains the statements that took the most time overall.
+        """
+        explainable = [
+            (key, stats)
+            for key, stats in self.statements.items()
+            if key.upper().startswith(EXPLAINABLE)
+        ]
+        explainable.sort(key=lambda entry: entry[1].total, reverse=True)
+
+        for key, stats in explainable[:top]:
+            try:
+                plan = await database.fetch_all(f"EXPLAIN {stats.query}", stats.values)
+            except Exception as exc:
+                self.plans[key] = {"explain_error": repr(exc)}
+                continue
+
+            steps = [dict(step._mapping) for step in plan]
+            flags = explain_flags(steps)
+            self.plans[key] = {"explain": steps, "flags": flags}
+
+            if flags:
+                self.log.warning(
+                    "query is likely missing an index",
+                    extra={"fields": {"query": key, "flags": "; ".join(flags)}},
+                )
+
+    def report(self) -> dict[str, Any]:
+        statements = sorted(
+            self.statements.items(), key=lambda entry: entry[1].total, reverse=True
+        )
+
+        return {
+            "started_at": self.started_at,
+            "queries": sum(stats.count for _, stats in statements),
+            "seconds": sum(stats.total for _, stats in statements),
+            "statements": [
+                {
+                    "fingerprint": key,
+                    "count": stats.count,
+                    "total": stats.total,
+                    "p95": stats.p95,
+                    "rows": stats.rows,
+                }
+                | self.plans.get(key, {})
+                for key, stats in statements
+            ],
+        }
+
+    async def save(self, redis: Redis, name: str) -> None:
+        # only the last profiled run of every job is kept.
+        await redis.set(profile_key(name), json.dumps(self.report(), default=str))
+
+
+def result_rows(method: str, result: Any) -> int:
+    if result is None:
+        return 0
+
+    if method == "fetch_all":
+        return len(result)
+
+    if method in ("fetch_one", "fetch_val"):
+        return 1
+
+    return 0
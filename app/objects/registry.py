@@ -0,0 +1,56 @@
+import importlib
+import os
+
+# every job, and the module that registers it.
+JOB_MODULES = {
+    "recalculate_user_stats": "app.jobs.recalculate_stats",
+    "recalculate_dirty_user_stats": "app.jobs.recalculate_stats",
+    "recalculate_submitted_stats": "app.jobs.submitted_scores",
+    "reconcile_leaderboards": "app.jobs.reconcile_leaderboards",
+    "fill_profile_history": "app.jobs.profile_history",
+    "compact_profile_history": "app.jobs.profile_history",
+    "ensure_loved_maps_dont_award_pp": "app.jobs.loved_maps",
+    "repopulate_redis_cache": "app.jobs.repopulate_redis_cache",
+    "replace_invalid_beatmaps": "app.jobs.replace_invalid_beatmaps",
+    "verify_beatmaps": "app.jobs.replace_invalid_beatmaps",
+}
+
+
+def parse_names(value: str) -> set[str] | None:
+    names = {name.strip() for name in value.split(",") if name.strip()}
+    return None if "*" in names else names
+
+
+def parse_intervals(value: str) -> dict[str, int]:
+    intervals = {}
+
+    for entry in filter(None, (entry.strip() for entry in value.split(","))):
+        name, _, interval = entry.partition("=")
+        intervals[name.strip()] = int(interval)
+
+    return intervals
+
+
+# the jobs this node hosts, "*" for all of them. the modules of the others
+# are never imported, so their dependencies and configuration aren't needed.
+ENABLED_JOBS = parse_names(os.getenv("CRON_JOBS", "*"))
+# intervals in seconds overriding the ones the jobs are registered with.
+JOB_INTERVALS = parse_intervals(os.getenv("CRON_JOB_INTERVALS", ""))
+
+
+def is_enabled(name: str) -> bool:
+    return ENABLED_JOBS is None or name in ENABLED_JOBS
+
+
+def import_jobs() -> None:
+    """
+    `import_jobs()` imports the modules of the enabled jobs, which registers
+    them. Jobs sharing a module with an enabled one aren't registered.
+    """
+    if unknown := ((ENABLED_JOBS or set()) | JOB_INTERVALS.keys()) - JOB_MODULES.keys():
+        raise ValueError(f"unknown jobs configured: {", ".join(sorted(unknown))}")
+
+    for module in dict.fromkeys(
+        module for name, module in JOB_MODULES.items() if is_enabled(name)
+    ):
+        importlib.import_module(module)
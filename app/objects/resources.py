@@ -0,0 +1,128 @@
+import asyncio
+import heapq
+import itertools
+import os
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Sequence
+
+DB_HEAVY = "db_heavy"  # long or wide queries against the database
+SCORES_WRITER = "scores_writer"  # bulk updates of the scores table
+DISK_SCAN = "disk_scan"  # walks the beatmaps directory
+USER_STATS = "user_stats"  # reads or writes stats and leaderboards of all users
+
+
+def parse_limits(value: str) -> dict[str, int]:
+    limits = {}
+
+    for entry in filter(None, (entry.strip() for entry in value.split(","))):
+        name, _, limit = entry.partition("=")
+        limits[name.strip()] = int(limit)
+
+    return limits
+
+
+# how many jobs may hold a resource at once, any resource that isn't
+# listed can only be held by a single job, which makes it an exclusion group.
+RESOURCE_LIMITS = {DB_HEAVY: 2} | parse_limits(os.getenv("CRON_RESOURCE_LIMITS", ""))
+
+
+class ResourcePool:
+    """
+    `ResourcePool` hands out the resources jobs declared, queueing the jobs
+    that would go over a resource's limit until it's released. Queued jobs
+    are let through by priority, and a lower priority job never takes a
+    resource a higher priority one is waiting for.
+    """
+
+    def __init__(self, limits: dict[str, int] = RESOURCE_LIMITS) -> None:
+        self.limits = limits
+        self.held: Counter[str] = Counter()
+        self.order = itertools.count()
+        # min-heap of (-priority, arrival, resources, future)
+        self.waiting: list[
+            tuple[int, int, tuple[str, ...], asyncio.Future[None]]
+        ] = []
+
+    def lacking(
+        self, resources: Sequence[str], reserved: Counter[str] | None = None
+    ) -> list[str]:
+        """
+        `lacking()` returns the resources that have no free slot left,
+        counting the slots `reserved` for jobs queued ahead as taken.
+        """
+        reserved = reserved or Counter()
+
+        return [
+            name
+            for name in resources
+            if self.held[name] + reserved[name] >= self.limits.get(name, 1)
+        ]
+
+    def fits(self, resources: Sequence[str]) -> bool:
+        return not self.lacking(resources)
+
+    def take(self, resources: Sequence[str]) -> None:
+        self.held.update(resources)
+
+    def grant(self) -> None:
+        """
+        `grant()` lets through every queued job whose resources are free.
+        """
+        reserved: Counter[str] = Counter()
+        still_waiting = []
+
+        for entry in sorted(self.waiting):
+            _, _, resources, future = entry
+
+            if future.done():
+                continue
+
+            if not (lacking := self.lacking(resources, reserved)):
+                self.take(resources)
+                future.set_result(None)
+                continue
+
+            # the next free slot of what it lacks is kept for this job, so jobs
+            # queued behind it don't starve it. the rest stays up for grabs.
+            reserved.update(lacking)
+            still_waiting.append(entry)
+
+        heapq.heapify(still_waiting)
+        self.waiting = still_waiting
+
+    def release(self, resources: Sequence[str]) -> None:
+        self.held.subtract(resources)
+        self.grant()
+
+    @asynccontextmanager
+    async def hold(
+        self, resources: Sequence[str], priority: int = 0
+    ) -> AsyncIterator[None]:
+        """
+        `hold()` waits until all `resources` are free, and holds them
+        for as long as the context is entered.
+        """
+        resources = tuple(sorted(set(resources)))
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (-priority, next(self.order), resources, future))
+        # it may fit right away, or past the jobs queued ahead of it.
+        self.grant()
+
+        if not future.done():
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # it was granted right as it was cancelled.
+                    self.release(resources)
+                else:
+                    self.grant()
+
+                raise
+
+        try:
+            yield
+        finally:
+            self.release(resources)
@@ -0,0 +1,354 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from enum import Enum
+from typing import Awaitable, Callable
+from pydantic import BaseModel
+from redis import Redis
+from app.objects.lease import NODE_ID, RELEASE_SCRIPT, RENEW_SCRIPT
+from app.objects.logs import job_logger
+from app.objects.sql import DB_POOL_MAX
+
+SHARD_RETRIES = int(os.getenv("CRON_SHARD_RETRIES", 3))
+# every shard holds a connection for its queries and another one prefetching
+# the next batch of users. the concurrent shards per node are kept within the
+# database pool, leaving a couple of connections for other jobs.
+SHARD_CONNECTIONS = 2
+SHARD_CONCURRENCY = int(os.getenv("CRON_SHARD_CONCURRENCY") or 0) or max(
+    1, (DB_POOL_MAX - 2) // SHARD_CONNECTIONS
+)
+# a claimed shard is queued again once its node stops renewing the claim
+# for this long, and a run gives up on the shards that aren't done by then.
+SHARD_CLAIM_TTL = int(os.getenv("CRON_SHARD_CLAIM_TTL", 30))  # seconds
+SHARD_RUN_TIMEOUT = int(os.getenv("CRON_SHARD_RUN_TIMEOUT", 6 * 3600))  # seconds
+
+SHARD_QUEUE_KEY = "ragnarok:cron:shard_queue"
+
+# puts an abandoned shard back, unless it changed or was claimed again
+# since it was read.
+REQUEUE_SCRIPT = """
+if redis.call("HGET", KEYS[1], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+if redis.call("EXISTS", KEYS[2]) == 1 then
+    return 0
+end
+redis.call("HSET", KEYS[1], ARGV[1], ARGV[3])
+if ARGV[4] ~= "" then
+    redis.call("RPUSH", KEYS[3], ARGV[4])
+end
+return 1
+"""
+
+log = logging.getLogger(__name__)
+
+
+class ShardStatus(str, Enum):
+    PENDING = "pending"
+    IN_PROGRESS = "in progress"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class Shard(BaseModel):
+    index: int
+    low: int
+    high: int
+    # ^^^^ the shard covers user ids from `low` up to, but not including, `high`
+
+    status: ShardStatus = ShardStatus.PENDING
+    processed: int = 0
+    attempts: int = 0
+
+    fencing_token: int | None = None
+    # ^^^^ the token of the run's lease, its checkpoints are fenced with it
+    # on whichever node runs the shard.
+
+
+def split_range(low: int, high: int, count: int) -> list[Shard]:
+    """
+    `split_range()` splits the ids from `low` up to `high` into `count`
+    evenly sized shards.
+    """
+    size = max(1, -(-(high - low) // count))
+
+    return [
+        Shard(index=idx, low=start, high=min(start + size, high))
+        for idx, start in enumerate(range(low, high, size))
+    ]
+
+
+ShardCallback = Callable[[Shard], Awaitable[None]]
+
+
+async def run_local(shards: list[Shard], callback: ShardCallback) -> None:
+    """
+    `run_local()` runs every shard concurrently on this node, retrying
+    failed shards on their own.
+    """
+    semaphore = asyncio.Semaphore(SHARD_CONCURRENCY)
+
+    async def run_shard(shard: Shard) -> None:
+        async with semaphore:
+            while shard.status != ShardStatus.DONE:
+                shard.attempts += 1
+                shard.status = ShardStatus.IN_PROGRESS
+
+                try:
+                    await callback(shard)
+                    shard.status = ShardStatus.DONE
+                except Exception as exc:
+                    shard.status = ShardStatus.FAILED
+                    log.warning(
+                        "shard %d failed, attempt %d",
+                        shard.index,
+                        shard.attempts,
+                        exc_info=exc,
+                    )
+
+                    if shard.attempts >= SHARD_RETRIES:
+                        return
+
+    await asyncio.gather(*(run_shard(shard) for shard in shards))
+
+
+def results_key(run_id: str) -> str:
+    return f"ragnarok:cron:shard_results:{run_id}"
+
+
+def claim_key(run_id: str, index: int) -> str:
+    return f"ragnarok:cron:shard_claim:{run_id}:{index}"
+
+
+def queue_item(job_name: str, run_id: str, shard: Shard) -> str:
+    return json.dumps({"job": job_name, "run": run_id, "shard": shard.model_dump()})
+
+
+class ShardClaim:
+    """
+    `ShardClaim` marks a shard as being run by this node. Like a job's lease
+    it expires unless it's renewed through `heartbeat()`, so the shards of a
+    crashed node are noticed and queued again.
+    """
+
+    def __init__(
+        self, redis: Redis, run_id: str, shard: Shard, ttl: int = SHARD_CLAIM_TTL
+    ) -> None:
+        self.redis = redis
+        self.key = claim_key(run_id, shard.index)
+        self.value = f"{NODE_ID}|{shard.attempts}"
+        self.ttl = ttl
+
+    async def acquire(self) -> None:
+        await self.redis.set(self.key, self.value, px=self.ttl * 1000)
+
+    async def renew(self) -> bool:
+        return bool(
+            await self.redis.eval(
+                RENEW_SCRIPT, 1, self.key, self.value, self.ttl * 1000
+            )
+        )
+
+    async def release(self) -> None:
+        await self.redis.eval(RELEASE_SCRIPT, 1, self.key, self.value)
+
+    async def heartbeat(self, holder: asyncio.Task) -> None:
+        """
+        `heartbeat()` keeps renewing the claim, and cancels `holder` if it
+        expired, as the shard has been queued again by then.
+        """
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+
+            if not await self.renew():
+                holder.cancel()
+                return
+
+
+async def requeue_abandoned(
+    redis: Redis,
+    job_name: str,
+    run_id: str,
+    shards: list[Shard],
+    results: dict[bytes, bytes],
+) -> None:
+    """
+    `requeue_abandoned()` queues the shards in progress whose claim expired
+    again, or fails them if they're out of attempts.
+    """
+    running = [shard for shard in shards if shard.status == ShardStatus.IN_PROGRESS]
+
+    if not running:
+        return
+
+    async with redis.pipeline(transaction=False) as pipe:
+        for shard in running:
+            pipe.exists(claim_key(run_id, shard.index))
+
+        claimed = await pipe.execute()
+
+    for shard, is_claimed in zip(running, claimed):
+        if is_claimed:
+            continue
+
+        previous = results[str(shard.index).encode()]
+        retried = shard.attempts < SHARD_RETRIES
+        shard.status = ShardStatus.PENDING if retried else ShardStatus.FAILED
+
+        if await redis.eval(
+            REQUEUE_SCRIPT,
+            3,
+            results_key(run_id),
+            claim_key(run_id, shard.index),
+            SHARD_QUEUE_KEY,
+            shard.index,
+            previous,
+            shard.model_dump_json(),
+            queue_item(job_name, run_id, shard) if retried else "",
+        ):
+            job_logger(job_name).warning(
+                "shard %d was abandoned, attempt %d", shard.index, shard.attempts
+            )
+
+
+async def run_distributed(
+    redis: Redis,
+    job_name: str,
+    run_id: str,
+    shards: list[Shard],
+    timeout: int = SHARD_RUN_TIMEOUT,
+) -> None:
+    """
+    `run_distributed()` queues every shard for the shard workers of all
+    cron nodes, and waits until they're all done or failed. Shards that
+    aren't done within `timeout` seconds are given up on as failed.
+    """
+    # the shards are known as pending up front, so workers can tell
+    # the shards of a cancelled run apart once its results are gone.
+    await redis.delete(results_key(run_id))
+    await redis.hset(
+        results_key(run_id),
+        mapping={shard.index: shard.model_dump_json() for shard in shards},
+    )
+    await redis.rpush(
+        SHARD_QUEUE_KEY, *(queue_item(job_name, run_id, shard) for shard in shards)
+    )
+    gives_up_at = time.monotonic() + timeout
+
+    try:
+        while True:
+            results = await redis.hgetall(results_key(run_id))
+
+            for index, result in results.items():
+                shards[int(index)] = Shard.model_validate_json(result)
+
+            unfinished = [
+                shard
+                for shard in shards
+                if shard.status not in (ShardStatus.DONE, ShardStatus.FAILED)
+            ]
+
+            if not unfinished:
+                return
+
+            if time.monotonic() >= gives_up_at:
+                job_logger(job_name).warning(
+                    "gave up on shards %s after %d seconds",
+                    [shard.index for shard in unfinished],
+                    timeout,
+                )
+
+                for shard in unfinished:
+                    shard.status = ShardStatus.FAILED
+
+                return
+
+            await requeue_abandoned(redis, job_name, run_id, shards, results)
+            await asyncio.sleep(1)
+    finally:
+        await redis.delete(results_key(run_id))
+
+
+async def shard_worker(
+    redis: Redis, callbacks: Callable[[str], ShardCallback | None]
+) -> None:
+    """
+    `shard_worker()` runs shards queued by any cron node, `callbacks`
+    returns the shard callback of a job that's currently running. It keeps
+    going through redis errors, the shard it was on when one happened is
+    queued again once its claim expires.
+    """
+    while True:
+        try:
+            await run_queued_shards(redis, callbacks)
+        except Exception as exc:
+            log.warning("shard worker failed (%r), restarting", exc)
+            await asyncio.sleep(1)
+
+
+async def run_queued_shards(
+    redis: Redis, callbacks: Callable[[str], ShardCallback | None]
+) -> None:
+    while True:
+        popped = await redis.blpop([SHARD_QUEUE_KEY], timeout=5)
+
+        if popped is None:
+            continue
+
+        item = json.loads(popped[1])
+        shard = Shard.model_validate(item["shard"])
+
+        if not await redis.exists(results_key(item["run"])):
+            # the run was cancelled or has given up on it.
+            continue
+
+        if (callback := callbacks(item["job"])) is None:
+            # the job isn't known to this node, leave it to the others.
+            await redis.rpush(SHARD_QUEUE_KEY, popped[1])
+            await asyncio.sleep(1)
+            continue
+
+        shard.attempts += 1
+        shard.status = ShardStatus.IN_PROGRESS
+
+        # claimed before it shows as in progress, so it's never seen
+        # in progress without a claim while it runs.
+        claim = ShardClaim(redis, item["run"], shard)
+        await claim.acquire()
+        await redis.hset(results_key(item["run"]), shard.index, shard.model_dump_json())
+
+        running = asyncio.create_task(callback(shard))
+        heartbeat = asyncio.create_task(claim.heartbeat(running))
+
+        try:
+            await asyncio.wait([running])
+        finally:
+            heartbeat.cancel()
+            running.cancel()
+
+        if running.cancelled():
+            job_logger(item["job"]).warning(
+                "lost the claim of shard %d, it was queued again", shard.index
+            )
+            continue
+
+        if (exc := running.exception()) is None:
+            shard.status = ShardStatus.DONE
+        else:
+            job_logger(item["job"]).warning(
+                "shard %d failed, attempt %d", shard.index, shard.attempts, exc_info=exc
+            )
+
+            if shard.attempts < SHARD_RETRIES:
+                # retry it on whichever node picks it up next.
+                shard.status = ShardStatus.PENDING
+                await redis.rpush(
+                    SHARD_QUEUE_KEY, queue_item(item["job"], item["run"], shard)
+                )
+            else:
+                shard.status = ShardStatus.FAILED
+
+        await redis.hset(results_key(item["run"]), shard.index, shard.model_dump_json())
+        await claim.release()
@@ -0,0 +1,21 @@
+import os
+from typing import Any, Iterable, Iterator, Sequence, TypeVar
+
+T = TypeVar("T")
+
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))
+
+
+def bind_in(name: str, values: Iterable[Any]) -> tuple[str, dict[str, Any]]:
+    """
+    `bind_in()` expands `values` into named placeholders usable in an
+    `IN (...)` clause, as `databases` can't bind sequences on its own.
+    """
+    params = {f"{name}_{idx}": value for idx, value in enumerate(values)}
+    return ", ".join(f":{key}" for key in params), params
+
+
+def chunked(values: Sequence[T], size: int) -> Iterator[Sequence[T]]:
+    for start in range(0, len(values), size):
+        yield values[start : start + size]
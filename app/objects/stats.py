@@ -0,0 +1,183 @@
+from dataclasses import dataclass
+from functools import cache
+from typing import TYPE_CHECKING, Any, Iterable, Mapping, Sequence
+from databases import Database
+from app.constants import MODE_PAIRS, Gamemode, PlayMode
+from app.objects.sql import bind_in
+
+if TYPE_CHECKING:
+    import numpy as np
+
+TOP_SCORES = 100
+
+SCORE_WATERMARK_KEY = "ragnarok:cron:stats_score_watermark"
+
+
+@dataclass
+class UserStats:
+    user_id: int
+    gamemode: Gamemode
+    play_mode: PlayMode
+    pp: float
+    accuracy: float
+
+
+@cache
+def weight_tables() -> "tuple[np.ndarray, np.ndarray, np.ndarray]":
+    """
+    `weight_tables()` returns the weight of every place, and the accuracy
+    factor and bonus pp of every amount of top scores.
+    """
+    # numpy is only loaded once stats are actually weighed.
+    import numpy as np
+
+    # the weights and bonuses are computed with python floats, so the
+    # vectorized results are bit-for-bit identical to the per-score loop.
+    return (
+        np.array([0.95**place for place in range(TOP_SCORES)]),
+        np.array(
+            [0.0]
+            + [100 / (20 * (1 - 0.95**count)) for count in range(1, TOP_SCORES + 1)]
+        ),
+        np.array([416.6667 * (1 - 0.9994**count) for count in range(TOP_SCORES + 1)]),
+    )
+
+
+def calculate_weighted_stats(
+    pp: "np.ndarray", accuracy: "np.ndarray", counts: "np.ndarray"
+) -> "tuple[np.ndarray, np.ndarray]":
+    """
+    `calculate_weighted_stats()` weighs a (n, 100) matrix of top scores,
+    sorted by pp and padded with zeros, into total pp and accuracy per row.
+    """
+    import numpy as np
+
+    score_weights, accuracy_factors, bonus_pp = weight_tables()
+    weighted_pp = np.zeros(len(counts))
+    overall_accuracy = np.zeros(len(counts))
+
+    # accumulate column by column to keep the summation order of the original
+    # loop, adding the zero padding doesn't change the sum.
+    for place in range(pp.shape[1]):
+        weighted_pp += pp[:, place] * score_weights[place]
+        overall_accuracy += accuracy[:, place] * score_weights[place]
+
+    # bonus accuracy
+    overall_accuracy *= accuracy_factors[counts]
+    overall_accuracy /= 100
+
+    # bonus pp
+    weighted_pp += bonus_pp[counts]
+
+    return weighted_pp, overall_accuracy
+
+
+async def fetch_top_scores(
+    database: Database,
+    user_ids: Sequence[int],
+    modes: Iterable[tuple[int, int]] | None = None,
+) -> Sequence[Mapping[str, Any]]:
+    """
+    `fetch_top_scores()` fetches the top 100 pp awarding scores for every
+    given user in every play- and gamemode with a single query, or only in
+    the given (gamemode, mode) pairs.
+    """
+    placeholders, values = bind_in("user_id", user_ids)
+    mode_filter = ""
+
+    if modes is not None:
+        pairs = []
+
+        for idx, (gamemode, mode) in enumerate(sorted(set(modes))):
+            values |= {f"gamemode_{idx}": gamemode, f"mode_{idx}": mode}
+            pairs.append(f"(:gamemode_{idx}, :mode_{idx})")
+
+        if not pairs:
+            return []
+
+        mode_filter = f"AND (gamemode, mode) IN ({", ".join(pairs)}) "
+
+    return await database.fetch_all(
+        "SELECT user_id, mode, gamemode, place, pp, accuracy FROM ("
+        "SELECT user_id, mode, gamemode, pp, accuracy, ROW_NUMBER() OVER ("
+        "PARTITION BY user_id, mode, gamemode ORDER BY pp DESC) AS place "
+        f"FROM scores WHERE user_id IN ({placeholders}) {mode_filter}"
+        "AND status = 3 AND awards_pp = 1"
+        f") ranked WHERE place <= {TOP_SCORES}",
+        values,
+    )
+
+
+def weigh_top_scores(scores: Sequence[Mapping[str, Any]]) -> list[UserStats]:
+    """
+    `weigh_top_scores()` groups the rows of `fetch_top_scores()` by user
+    and mode, then weighs every group at once.
+    """
+    import numpy as np
+
+    groups: dict[tuple[int, int, int], int] = {}
+
+    for score in scores:
+        key = (score["user_id"], score["gamemode"], score["mode"])
+        groups.setdefault(key, len(groups))
+
+    pp = np.zeros((len(groups), TOP_SCORES))
+    accuracy = np.zeros((len(groups), TOP_SCORES))
+    counts = np.zeros(len(groups), dtype=np.intp)
+
+    for score in scores:
+        row = groups[(score["user_id"], score["gamemode"], score["mode"])]
+        place = score["place"] - 1
+
+        pp[row, place] = score["pp"]
+        accuracy[row, place] = score["accuracy"]
+        counts[row] += 1
+
+    weighted_pp, overall_accuracy = calculate_weighted_stats(pp, accuracy, counts)
+
+    return [
+        UserStats(
+            user_id=user_id,
+            gamemode=Gamemode(gamemode),
+            play_mode=PlayMode(mode),
+            pp=float(weighted_pp[row]),
+            accuracy=float(overall_accuracy[row]),
+        )
+        for (user_id, gamemode, mode), row in groups.items()
+        if (Gamemode(gamemode), PlayMode(mode)) in MODE_PAIRS
+    ]
+
+
+async def update_user_stats(database: Database, stats: Sequence[UserStats]) -> None:
+    """
+    `update_user_stats()` writes the stats back with one multi-row
+    UPDATE per stats table and play mode.
+    """
+    grouped: dict[tuple[Gamemode, PlayMode], list[UserStats]] = {}
+
+    for entry in stats:
+        grouped.setdefault((entry.gamemode, entry.play_mode), []).append(entry)
+
+    for (gamemode, play_mode), entries in grouped.items():
+        values: dict[str, Any] = {}
+        pp_cases = []
+        accuracy_cases = []
+
+        for idx, entry in enumerate(entries):
+            values |= {
+                f"id_{idx}": entry.user_id,
+                f"pp_{idx}": entry.pp,
+                f"acc_{idx}": entry.accuracy,
+            }
+            pp_cases.append(f"WHEN :id_{idx} THEN :pp_{idx}")
+            accuracy_cases.append(f"WHEN :id_{idx} THEN :acc_{idx}")
+
+        ids = ", ".join(f":id_{idx}" for idx in range(len(entries)))
+
+        await database.execute(
+            query=f"UPDATE {gamemode.table} SET "
+            f"{play_mode.to_db("pp")} = CASE id {" ".join(pp_cases)} END, "
+            f"{play_mode.to_db("accuracy")} = CASE id {" ".join(accuracy_cases)} END "
+            f"WHERE id IN ({ids})",
+            values=values,
+        )
@@ -0,0 +1,148 @@
+import asyncio
+import time
+from typing import AsyncIterator
+from redis import Redis
+from redis.exceptions import ResponseError
+from app.objects.lease import NODE_ID
+
+CONSUMER_GROUP = "ragnarok-cron"
+STREAM_BATCH_SIZE = 500
+# events a consumer hasn't acknowledged for this long are taken over by
+# another one, as its node most likely crashed while handling them.
+STREAM_CLAIM_IDLE = 60_000  # milliseconds
+# how often the events every consumer group is done with are trimmed away.
+STREAM_TRIM_INTERVAL = 60  # seconds
+# the longest a consumer waits to reconnect after losing the stream.
+STREAM_MAX_BACKOFF = 30  # seconds
+
+StreamEvent = tuple[str, dict[str, str]]
+
+
+def parse_id(event_id: bytes | str) -> tuple[int, int]:
+    milliseconds, _, sequence = (
+        event_id.decode() if isinstance(event_id, bytes) else event_id
+    ).partition("-")
+    return int(milliseconds), int(sequence or 0)
+
+
+def decode_event(event_id: bytes, fields: dict[bytes, bytes]) -> StreamEvent:
+    return event_id.decode(), {
+        key.decode(): value.decode() for key, value in fields.items()
+    }
+
+
+class StreamConsumer:
+    """
+    `StreamConsumer` reads events from a redis stream as part of a consumer
+    group, so every cron node shares the events between them. Events that
+    come in shortly after each other are handed out together, and only
+    count as handled once they're acknowledged.
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        stream: str,
+        debounce: float = 0,
+        group: str = CONSUMER_GROUP,
+        batch_size: int = STREAM_BATCH_SIZE,
+    ) -> None:
+        self.redis = redis
+        self.stream = stream
+        self.debounce = debounce
+        self.group = group
+        self.batch_size = batch_size
+        self.trimmed_at = 0.0
+
+    async def create_group(self) -> None:
+        try:
+            await self.redis.xgroup_create(
+                self.stream, self.group, id="0", mkstream=True
+            )
+        except ResponseError as exc:
+            if "BUSYGROUP" not in str(exc):
+                raise
+
+    async def read(self, count: int, block: int | None) -> list[StreamEvent]:
+        response = await self.redis.xreadgroup(
+            self.group, NODE_ID, {self.stream: ">"}, count=count, block=block
+        )
+
+        if not response:
+            return []
+
+        _, events = response[0]
+        return [decode_event(event_id, fields) for event_id, fields in events]
+
+    async def claim(self) -> list[StreamEvent]:
+        _, events, *_ = await self.redis.xautoclaim(
+            self.stream,
+            self.group,
+            NODE_ID,
+            min_idle_time=STREAM_CLAIM_IDLE,
+            start_id="0-0",
+            count=self.batch_size,
+        )
+
+        # events deleted from the stream in the meantime come back empty.
+        return [decode_event(event_id, fields) for event_id, fields in events if fields]
+
+    async def ack(self, events: list[StreamEvent]) -> None:
+        if events:
+            await self.redis.xack(self.stream, self.group, *(e[0] for e in events))
+
+        if time.monotonic() - self.trimmed_at >= STREAM_TRIM_INTERVAL:
+            self.trimmed_at = time.monotonic()
+            await self.trim()
+
+    async def trim(self) -> None:
+        """
+        `trim()` removes the events every consumer group of the stream has
+        read and acknowledged, as the producer doesn't cap the stream.
+        """
+        oldest: list[tuple[int, int]] = []
+
+        for group in await self.redis.xinfo_groups(self.stream):
+            oldest.append(parse_id(group["last-delivered-id"]))
+
+            if group["pending"]:
+                pending = await self.redis.xpending(self.stream, group["name"])
+                oldest.append(parse_id(pending["min"]))
+
+        if oldest:
+            milliseconds, sequence = min(oldest)
+            await self.redis.xtrim(self.stream, minid=f"{milliseconds}-{sequence}")
+
+    async def batches(self) -> AsyncIterator[list[StreamEvent]]:
+        """
+        `batches()` waits for events, then keeps collecting them for the
+        debounce window, or until the batch is full, and yields them.
+        """
+        await self.create_group()
+
+        while True:
+            if batch := await self.claim():
+                yield batch
+                continue
+
+            batch = await self.read(self.batch_size, block=5000)
+
+            if not batch:
+                continue
+
+            window_ends = time.monotonic() + self.debounce
+
+            while len(batch) < self.batch_size:
+                remaining = window_ends - time.monotonic()
+
+                if remaining <= 0:
+                    break
+
+                batch += await self.read(
+                    self.batch_size - len(batch), block=max(1, int(remaining * 1000))
+                )
+
+            yield batch
+
+            # let other tasks in between very busy batches.
+            await asyncio.sleep(0)
@@ -0,0 +1,194 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from contextvars import ContextVar
+from datetime import datetime
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, ContextManager, Iterator
+
+# the share of runs that are traced, from 0 (none) to 1 (all of them).
+TRACE_RATE = float(os.getenv("CRON_TRACE_RATE", 0))
+TRACE_DIRECTORY = Path(os.getenv("CRON_TRACE_DIRECTORY", "traces"))
+TRACE_KEEP = int(os.getenv("CRON_TRACE_KEEP", 100))  # files
+
+# the event loop is considered stalled when a sleep of `STALL_INTERVAL`
+# seconds wakes up more than `STALL_THRESHOLD` seconds late.
+STALL_INTERVAL = 0.05
+STALL_THRESHOLD = 0.02
+
+log = logging.getLogger(__name__)
+
+# the trace of the run the current task belongs to, tasks started
+# by the run inherit it.
+current_trace: ContextVar["Trace | None"] = ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """
+    `Trace` records the spans of a single job run as chrome trace events,
+    which can be loaded into chrome://tracing or https://ui.perfetto.dev.
+    Every task gets its own track, so concurrent shards or workers show up
+    side by side.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.started_at = time.time()
+        self.origin = time.perf_counter()
+        self.tracks: dict[int, int] = {}
+        self.events: list[dict[str, Any]] = [
+            {"name": "process_name", "ph": "M", "pid": 1, "args": {"name": name}}
+        ]
+
+    def track(self) -> int:
+        task = asyncio.current_task()
+
+        if (tid := self.tracks.get(id(task))) is None:
+            tid = self.tracks[id(task)] = len(self.tracks) + 1
+            self.events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": 1,
+                    "tid": tid,
+                    "args": {"name": task.get_name() if task else "main"},
+                }
+            )
+
+        return tid
+
+    def record(
+        self,
+        name: str,
+        category: str,
+        started_at: float,
+        ended_at: float,
+        args: dict[str, Any] | None = None,
+    ) -> None:
+        self.events.append(
+            {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (started_at - self.origin) * 1e6,
+                "dur": (ended_at - started_at) * 1e6,
+                "pid": 1,
+                "tid": self.track(),
+                "args": args or {},
+            }
+        )
+
+    @contextmanager
+    def span(self, name: str, category: str = "job", **args: Any) -> Iterator[None]:
+        started_at = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.record(name, category, started_at, time.perf_counter(), args)
+
+    async def watch_loop(self) -> None:
+        """
+        `watch_loop()` records the times the event loop was blocked,
+        for as long as the run is traced.
+        """
+        while True:
+            expected_at = time.perf_counter() + STALL_INTERVAL
+            await asyncio.sleep(STALL_INTERVAL)
+
+            if (lag := time.perf_counter() - expected_at) >= STALL_THRESHOLD:
+                self.record("event loop stall", "loop", expected_at, expected_at + lag)
+
+    def save(self, directory: Path = TRACE_DIRECTORY, keep: int = TRACE_KEEP) -> Path:
+        """
+        `save()` writes the trace into `directory`, and removes the oldest
+        traces so only `keep` of them are left.
+        """
+        directory.mkdir(parents=True, exist_ok=True)
+
+        started_at = datetime.fromtimestamp(self.started_at)
+        path = directory / f"{self.name}-{started_at:%Y%m%d-%H%M%S-%f}.json"
+        path.write_text(
+            json.dumps(
+                {
+                    "traceEvents": self.events,
+                    "displayTimeUnit": "ms",
+                    "otherData": {"job": self.name, "started_at": self.started_at},
+                },
+                default=str,
+            )
+        )
+
+        traces = sorted(directory.glob("*.json"), key=lambda file: file.stat().st_mtime)
+
+        for stale in traces[: max(len(traces) - keep, 0)]:
+            stale.unlink(missing_ok=True)
+
+        return path
+
+
+def span(name: str, category: str = "job", **args: Any) -> ContextManager[None]:
+    """
+    `span()` records a span in the trace of the current run,
+    and does nothing if the run isn't traced.
+    """
+    if (trace := current_trace.get()) is None:
+        return nullcontext()
+
+    return trace.span(name, category, **args)
+
+
+def traced(
+    method: Callable,
+    category: str,
+    name: str,
+    describe: Callable[..., dict[str, Any]] | None = None,
+) -> Callable:
+    """
+    `traced()` records every call of a coroutine function as a span,
+    with the arguments `describe` returns for the call.
+    """
+
+    async def wrapper(*args, **kwargs) -> Any:
+        if (trace := current_trace.get()) is None:
+            return await method(*args, **kwargs)
+
+        span_args = describe(*args, **kwargs) if describe is not None else {}
+
+        with trace.span(name, category, **span_args):
+            return await method(*args, **kwargs)
+
+    return wrapper
+
+
+@asynccontextmanager
+async def trace_run(name: str) -> AsyncIterator[None]:
+    """
+    `trace_run()` traces a sample of a job's runs, and writes the
+    trace of each of them to its own file once it's over.
+    """
+    # only a sample of runs is traced, to keep the overhead negligible.
+    if TRACE_RATE <= 0 or random.random() >= TRACE_RATE:
+        yield
+        return
+
+    trace = Trace(name)
+    token = current_trace.set(trace)
+    watcher = asyncio.create_task(trace.watch_loop(), name="event loop")
+
+    try:
+        with trace.span("run", "framework"):
+            yield
+    finally:
+        watcher.cancel()
+        current_trace.reset(token)
+
+        try:
+            path = await asyncio.to_thread(trace.save)
+            log.info("traced run of %s", name, extra={"fields": {"trace": path}})
+        except OSError as exc:
+            log.warning("failed to save the trace of %s (%r)", name, exc)
@@ -0,0 +1,60 @@
+import asyncio
+from typing import Any, AsyncIterator, Mapping, Sequence
+from databases import Database
+
+USERS_PER_BATCH = 500
+
+
+async def iterate_users(
+    database: Database,
+    columns: Sequence[str] = ("id",),
+    where: str = "1",
+    values: Mapping[str, Any] | None = None,
+    after: int = 0,
+    before: int | None = None,
+    batch_size: int = USERS_PER_BATCH,
+    prefetch: bool = False,
+) -> AsyncIterator[Sequence[Mapping[str, Any]]]:
+    """
+    `iterate_users()` yields batches of users matching `where`, with only
+    the given `columns`, ordered by id from after `after` up to `before`.
+    It pages by id rather than by offset, so only a single batch is ever held
+    in memory. With `prefetch`, the next batch is fetched while the current
+    one is being processed.
+    """
+    if "id" not in columns:
+        columns = ("id", *columns)
+
+    query = (
+        f"SELECT {", ".join(columns)} FROM users WHERE ({where}) AND id > :last_id "
+        + ("AND id < :before " if before is not None else "")
+        + "ORDER BY id LIMIT :limit"
+    )
+    params: dict[str, Any] = dict(values or {}) | {"limit": batch_size}
+
+    if before is not None:
+        params["before"] = before
+
+    async def fetch(last_id: int) -> Sequence[Mapping[str, Any]]:
+        return await database.fetch_all(query, params | {"last_id": last_id})
+
+    batch = await fetch(after)
+
+    while batch:
+        # a short batch is always the last one.
+        if len(batch) < batch_size:
+            yield batch
+            return
+
+        if not prefetch:
+            yield batch
+            batch = await fetch(batch[-1]["id"])
+            continue
+
+        upcoming = asyncio.create_task(fetch(batch[-1]["id"]))
+
+        try:
+            yield batch
+            batch = await upcoming
+        finally:
+            upcoming.cancel()
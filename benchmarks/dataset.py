@@ -0,0 +1,286 @@
+import hashlib
+import random
+import time
+from dataclasses import dataclass
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Any, Sequence
+from databases import Database
+from redis import Redis
+from app.constants import MODE_PAIRS, Gamemode, PlayMode
+from app.objects.leaderboard import leaderboard_keys, write_leaderboards
+from app.objects.sql import chunked
+
+SCALES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+# ^^^^ the amount of users, every other table is sized relative to it.
+
+SCORES_PER_USER = 5
+USERS_PER_BEATMAP = 10
+LOVED_RATIO = 0.05
+CORRUPTED_RATIO = 0.02
+TRUNCATED_RATIO = 0.01
+INACTIVE_RATIO = 0.3
+RESTRICTED_RATIO = 0.05
+# users with a daily profile history this many days back, for the compaction.
+HISTORY_RATIO = 0.01
+HISTORY_DAYS = 400
+# leaderboard members with a pp or country the stats tables no longer have.
+LEADERBOARD_DRIFT_RATIO = 0.05
+
+INSERT_BATCH_SIZE = 2000
+COUNTRIES = ("de", "fr", "gb", "jp", "kr", "pl", "ru", "us", "br", "ca", "xx")
+
+RATELIMITED_PAGE = """
+<html>
+<head><title>429 Too Many Requests</title></head>
+<body>
+<center><h1>429 Too Many Requests</h1></center>
+<hr><center>nginx</center>
+</body>
+</html>
+"""
+
+# the tables only the cron uses, which the server schema below lacks.
+MIGRATIONS = Path(__file__).parents[1] / "migrations"
+
+STATS_COLUMNS = ", ".join(
+    f"{mode.to_db(column)} FLOAT NOT NULL DEFAULT 0"
+    for mode in PlayMode
+    for column in ("pp", "accuracy")
+)
+SCHEMA = (
+    "CREATE TABLE users ("
+    "id INT NOT NULL PRIMARY KEY, username VARCHAR(32) NOT NULL, "
+    "country CHAR(2) NOT NULL, privileges INT NOT NULL, "
+    "latest_activity_time INT NOT NULL)",
+    f"CREATE TABLE stats (id INT NOT NULL PRIMARY KEY, {STATS_COLUMNS})",
+    f"CREATE TABLE stats_rx (id INT NOT NULL PRIMARY KEY, {STATS_COLUMNS})",
+    "CREATE TABLE beatmaps ("
+    "map_id INT NOT NULL PRIMARY KEY, map_md5 CHAR(32) NOT NULL, "
+    "approved TINYINT NOT NULL, KEY (map_md5))",
+    "CREATE TABLE scores ("
+    "id INT NOT NULL AUTO_INCREMENT PRIMARY KEY, user_id INT NOT NULL, "
+    "map_md5 CHAR(32) NOT NULL, gamemode TINYINT NOT NULL, mode TINYINT NOT NULL, "
+    "pp FLOAT NOT NULL, accuracy FLOAT NOT NULL, status TINYINT NOT NULL, "
+    "awards_pp TINYINT NOT NULL, KEY (user_id), KEY (map_md5))",
+    "CREATE TABLE profile_history ("
+    "id INT NOT NULL AUTO_INCREMENT PRIMARY KEY, user_id INT NOT NULL, "
+    "gamemode TINYINT NOT NULL, mode TINYINT NOT NULL, pp INT NOT NULL, "
+    "rank INT NOT NULL, timestamp DATE NOT NULL DEFAULT (CURRENT_DATE), "
+    "KEY (timestamp), KEY (user_id))",
+) + tuple(migration.read_text() for migration in sorted(MIGRATIONS.glob("*.sql")))
+TABLES = (
+    "users",
+    "stats",
+    "stats_rx",
+    "beatmaps",
+    "scores",
+    "profile_history",
+    "profile_history_rollups",
+)
+
+
+@dataclass
+class Dataset:
+    users: int
+    beatmaps: int
+    scores: int
+    files: int
+    history: int
+
+
+def dot_osu(map_id: int) -> str:
+    """
+    `dot_osu()` returns the .osu file of a map, the same for every run so
+    the local mirrors serve exactly what the beatmaps table expects.
+    """
+    rng = random.Random(map_id)
+    hit_objects = "\n".join(
+        f"{rng.randrange(512)},{rng.randrange(384)},{idx * 250},1,0,0:0:0:0:"
+        for idx in range(rng.randrange(200, 1200))
+    )
+
+    return (
+        "osu file format v14\n\n[General]\nMode: 0\n\n"
+        f"[Metadata]\nTitle:Benchmark {map_id}\nBeatmapID:{map_id}\n\n"
+        f"[HitObjects]\n{hit_objects}\n"
+    )
+
+
+async def insert_rows(
+    database: Database, table: str, rows: Sequence[dict[str, Any]]
+) -> None:
+    if not rows:
+        return
+
+    columns = list(rows[0])
+
+    for batch in chunked(rows, INSERT_BATCH_SIZE):
+        values: dict[str, Any] = {}
+        placeholders = []
+
+        for idx, row in enumerate(batch):
+            values |= {f"{column}_{idx}": row[column] for column in columns}
+            placeholders.append(
+                "(" + ", ".join(f":{column}_{idx}" for column in columns) + ")"
+            )
+
+        await database.execute(
+            f"INSERT INTO {table} ({", ".join(columns)}) "
+            f"VALUES {", ".join(placeholders)}",
+            values,
+        )
+
+
+async def create_schema(database: Database) -> None:
+    for table in TABLES:
+        await database.execute(f"DROP TABLE IF EXISTS {table}")
+
+    for statement in SCHEMA:
+        await database.execute(statement)
+
+
+async def seed(
+    database: Database,
+    directory: Path,
+    users: int,
+    seed: int = 0,
+    scores_per_user: int = SCORES_PER_USER,
+) -> Dataset:
+    """
+    `seed()` fills the database and the .osu directory with a synthetic
+    server of `users` players, the same for every `seed`.
+    """
+    rng = random.Random(seed)
+    now = int(time.time())
+
+    await create_schema(database)
+
+    # the first user is the bot, like on the server.
+    for chunk in chunked(range(1, users + 1), INSERT_BATCH_SIZE * 10):
+        user_rows = [
+            {
+                "id": user_id,
+                "username": f"user{user_id}",
+                "country": rng.choice(COUNTRIES),
+                "privileges": 0 if rng.random() < RESTRICTED_RATIO else 7,
+                "latest_activity_time": (
+                    now - rng.randrange(86400 * 180, 86400 * 365)
+                    if rng.random() < INACTIVE_RATIO
+                    else now - rng.randrange(86400 * 30)
+                ),
+            }
+            for user_id in chunk
+        ]
+        stats_rows = [{"id": user_id} for user_id in chunk]
+
+        await insert_rows(database, "users", user_rows)
+        await insert_rows(database, "stats", stats_rows)
+        await insert_rows(database, "stats_rx", stats_rows)
+
+    beatmaps = max(1, users // USERS_PER_BEATMAP)
+    map_md5s = []
+    directory.mkdir(parents=True, exist_ok=True)
+
+    for chunk in chunked(range(1, beatmaps + 1), INSERT_BATCH_SIZE * 10):
+        rows = []
+
+        for map_id in chunk:
+            content = dot_osu(map_id)
+            md5 = hashlib.md5(content.encode()).hexdigest()
+            map_md5s.append(md5)
+            rows.append(
+                {
+                    "map_id": map_id,
+                    "map_md5": md5,
+                    "approved": 5 if rng.random() < LOVED_RATIO else 2,
+                }
+            )
+
+            # some files were saved from an error page or cut off.
+            roll = rng.random()
+
+            if roll < CORRUPTED_RATIO:
+                content = RATELIMITED_PAGE
+            elif roll < CORRUPTED_RATIO + TRUNCATED_RATIO:
+                content = content[:200]
+
+            (directory / f"{map_id}.osu").write_text(content)
+
+        await insert_rows(database, "beatmaps", rows)
+
+    scores = users * scores_per_user
+
+    for chunk in chunked(range(scores), INSERT_BATCH_SIZE * 10):
+        rows = []
+
+        for _ in chunk:
+            gamemode, mode = rng.choice(MODE_PAIRS)
+            rows.append(
+                {
+                    "user_id": rng.randrange(2, users + 1) if users > 1 else 1,
+                    "map_md5": rng.choice(map_md5s),
+                    "gamemode": gamemode.value,
+                    "mode": mode.value,
+                    "pp": round(rng.gammavariate(2, 60), 3),
+                    "accuracy": round(rng.uniform(80, 100), 2),
+                    "status": 3 if rng.random() < 0.6 else 2,
+                    "awards_pp": 1,
+                }
+            )
+
+        await insert_rows(database, "scores", rows)
+
+    history_users = rng.sample(range(1, users + 1), max(1, int(users * HISTORY_RATIO)))
+    history = len(history_users) * HISTORY_DAYS
+    today = date.today()
+
+    for chunk in chunked(history_users, max(1, INSERT_BATCH_SIZE * 10 // HISTORY_DAYS)):
+        rows = [
+            {
+                "user_id": user_id,
+                "gamemode": Gamemode.VANILLA.value,
+                "mode": PlayMode.OSU.value,
+                "pp": 1000 + days_ago + rng.randrange(50),
+                "rank": user_id + rng.randrange(100),
+                "timestamp": today - timedelta(days=days_ago),
+            }
+            for user_id in chunk
+            for days_ago in range(HISTORY_DAYS, 0, -1)
+        ]
+
+        await insert_rows(database, "profile_history", rows)
+
+    return Dataset(
+        users=users, beatmaps=beatmaps, scores=scores, files=beatmaps, history=history
+    )
+
+
+async def seed_leaderboards(database: Database, redis: Redis, seed: int = 0) -> None:
+    """
+    `seed_leaderboards()` fills the osu! standard leaderboards from the stats
+    table, restricted users included, with some members drifted to another
+    pp or country, so reconciling them has something to correct.
+    """
+    rng = random.Random(seed)
+    gamemode, play_mode = Gamemode.VANILLA, PlayMode.OSU
+    rows = await database.fetch_all(
+        f"SELECT u.id, u.country, s.{play_mode.to_db("pp")} AS pp FROM users u "
+        f"INNER JOIN {gamemode.table} s ON s.id = u.id "
+        f"WHERE s.{play_mode.to_db("pp")} > 0"
+    )
+    leaderboards: dict[str, dict[str, float]] = {}
+
+    for row in rows:
+        country, pp = row["country"], float(row["pp"])
+
+        if rng.random() < LEADERBOARD_DRIFT_RATIO:
+            if rng.random() < 0.5:
+                country = rng.choice(COUNTRIES)
+            else:
+                pp *= rng.uniform(0.5, 1.5)
+
+        for key in leaderboard_keys(gamemode.name.lower(), play_mode.value, country):
+            leaderboards.setdefault(key, {})[str(row["id"])] = pp
+
+    await write_leaderboards(redis, leaderboards)
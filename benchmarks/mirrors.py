@@ -0,0 +1,98 @@
+import time
+from aiohttp import web
+from benchmarks.dataset import RATELIMITED_PAGE, dot_osu
+
+BANCHO_LIMIT = 50  # requests per second
+MINO_LIMIT = 100
+# every so many maps are missing on a mirror, to exercise the failover.
+BANCHO_MISSING_EVERY = 20
+MINO_MISSING_EVERY = 50
+
+
+class Window:
+    """
+    `Window` counts requests in fixed one second windows, like the
+    ratelimits of the real mirrors.
+    """
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.started_at = 0
+        self.count = 0
+
+    def hit(self) -> int:
+        """
+        `hit()` counts a request and returns how many are left in the window,
+        or -1 if it's over the limit.
+        """
+        now = int(time.monotonic())
+
+        if now != self.started_at:
+            self.started_at, self.count = now, 0
+
+        self.count += 1
+        return self.limit - self.count if self.count <= self.limit else -1
+
+
+class LocalMirrors:
+    """
+    `LocalMirrors` serves .osu files like osu.ppy.sh and mino do, including
+    their 429 responses, so beatmap jobs can run without the internet.
+    """
+
+    def __init__(self) -> None:
+        self.bancho = Window(BANCHO_LIMIT)
+        self.mino = Window(MINO_LIMIT)
+        self.runner: web.AppRunner | None = None
+        self.url = ""
+
+    async def bancho_osu(self, request: web.Request) -> web.Response:
+        if self.bancho.hit() < 0:
+            # bancho answers with the nginx page, without any headers to go by.
+            return web.Response(
+                status=429, text=RATELIMITED_PAGE, content_type="text/html"
+            )
+
+        map_id = int(request.match_info["map_id"])
+
+        # bancho answers missing maps with an empty 200.
+        if map_id % BANCHO_MISSING_EVERY == 0:
+            return web.Response(text="")
+
+        return web.Response(text=dot_osu(map_id))
+
+    async def mino_osu(self, request: web.Request) -> web.Response:
+        remaining = self.mino.hit()
+        headers = {
+            "X-RateLimit-Limit": str(MINO_LIMIT),
+            "X-RateLimit-Remaining": str(max(remaining, 0)),
+            "Retry-After": "1",
+        }
+
+        if remaining < 0:
+            return web.Response(status=429, headers=headers, text="ratelimited")
+
+        map_id = int(request.match_info["map_id"])
+
+        if map_id % MINO_MISSING_EVERY == 0:
+            return web.Response(status=404, headers=headers)
+
+        return web.Response(headers=headers, text=dot_osu(map_id))
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/bancho/{map_id}", self.bancho_osu)
+        app.router.add_get("/mino/{map_id}", self.mino_osu)
+
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+
+        host, port = self.runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
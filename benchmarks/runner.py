@@ -0,0 +1,102 @@
+"""
+Runs a single job against the benchmark database, a redis fake and the
+local mirrors, and writes its measurements to a json file. It's started
+by `python -m benchmarks` in its own process, so peak memory is per job.
+
+usage: python -m benchmarks.runner <job name> <result path>
+"""
+
+import asyncio
+import json
+import os
+import resource
+import sys
+import time
+from typing import Any
+
+# the mirrors are local, so allow more than the real ones do. it's still
+# above their limits, so the ratelimit handling is part of every run.
+BANCHO_RATE = 60  # requests per second
+MINO_RATE = 120
+
+
+async def run_job(name: str) -> dict[str, Any]:
+    # the jobs read their configuration on import, so only import them
+    # once the framework uses the stand-ins.
+    import fakeredis
+    from databases import Database
+    from app.objects.framework import config
+    from app.objects.logs import setup_logging
+    from app.objects.mirrors import TokenBucket
+    from app.objects.registry import import_jobs
+    from benchmarks.dataset import seed_leaderboards
+    from benchmarks.mirrors import LocalMirrors
+
+    setup_logging()
+
+    config.database = Database(os.environ["BENCHMARK_DATABASE_URL"])
+    config.redis = fakeredis.FakeAsyncRedis()
+
+    import_jobs()
+
+    from app.jobs import replace_invalid_beatmaps as beatmap_jobs
+
+    mirrors = LocalMirrors()
+    await mirrors.start()
+
+    beatmap_jobs.BANCHO_OSU_ENDPOINT.endpoint = f"{mirrors.url}/bancho/{{map_id}}"
+    beatmap_jobs.BANCHO_OSU_ENDPOINT.bucket = TokenBucket(BANCHO_RATE, BANCHO_RATE)
+    beatmap_jobs.MINO_OSU_ENDPOINT.endpoint = f"{mirrors.url}/mino/{{map_id}}"
+    beatmap_jobs.MINO_OSU_ENDPOINT.bucket = TokenBucket(MINO_RATE, MINO_RATE)
+
+    await config.database.connect()
+
+    # every run has a fresh redis, so the leaderboards to reconcile are
+    # filled from the stats the previous runs left behind.
+    if name == "reconcile_leaderboards":
+        await seed_leaderboards(
+            config.database, config.redis, int(os.getenv("BENCHMARK_SEED", 0))
+        )
+
+    job = config.jobs[name]
+    metrics = config.metrics[name]
+    error = None
+    started_at = time.perf_counter()
+
+    try:
+        await config.run(job)
+    except Exception as exc:
+        error = repr(exc)
+
+    wall_time = time.perf_counter() - started_at
+
+    await config.database.disconnect()
+    await mirrors.stop()
+
+    return {
+        "job": name,
+        "success": error is None and metrics.successes > 0,
+        "error": error,
+        "wall_time": wall_time,
+        "queries": metrics.db_queries,
+        "query_seconds": metrics.db_seconds,
+        "redis_commands": metrics.redis_commands,
+        "redis_seconds": metrics.redis_seconds,
+        # kilobytes on linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "children_peak_rss_mb": (
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+        ),
+    }
+
+
+def main() -> None:
+    name, result_path = sys.argv[1:3]
+    result = asyncio.run(run_job(name))
+
+    with open(result_path, "w") as f:
+        json.dump(result, f)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+-- the period, pp range and rank range of the profile history rows that
+-- compact_profile_history kept for a whole week or month.
+CREATE TABLE IF NOT EXISTS profile_history_rollups (
+    history_id INT NOT NULL PRIMARY KEY,
+    period VARCHAR(8) NOT NULL,
+    pp_min INT NOT NULL,
+    pp_max INT NOT NULL,
+    rank_min INT NOT NULL,
+    rank_max INT NOT NULL
+);